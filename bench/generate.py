@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Synthetic inputs for the benchmarks.
+
+    python bench/generate.py css [-n RULES] [-d DEPTH] [-f FANOUT] [-c CHILDREN] > big.cssc
+    python bench/generate.py sprite [-n IMAGES] DIR     # writes DIR/sprite.yaml
+"""
+
+import os
+import sys
+import random
+import optparse
+
+import yaml
+
+
+def make_stylesheet(rules=1000, depth=2, fanout=2, children=1, declarations=4, seed=0):
+    """Return a CSSC document of `rules` top level rulesets.
+
+    Each ruleset has `fanout` comma separated selectors, `declarations`
+    declarations and `children` nested rulesets, down to `depth` levels.
+    """
+    rnd = random.Random(seed)
+    properties = [
+        lambda: 'color: #%06x;' % rnd.randrange(0x1000000),
+        lambda: 'margin: %dpx %dpx;' % (rnd.randrange(20), rnd.randrange(20)),
+        lambda: 'border-radius: %dpx;' % rnd.randrange(10),
+        lambda: 'opacity: 0.%d;' % rnd.randrange(10),
+        lambda: 'font: normal %d%% Georgia, serif;' % rnd.randrange(80, 150),
+        lambda: 'background: url(/img/%d.png) no-repeat;' % rnd.randrange(100),
+    ]
+    counter = [0]
+
+    def selector():
+        counter[0] += 1
+        n = counter[0]
+        return rnd.choice(['.c%d' % n, '#i%d' % n, 'div.c%d' % n, '> .c%d' % n,
+                           '_:hover', 'a.c%d span' % n])
+
+    def ruleset(level, indent):
+        selectors = [selector() for _ in xrange(fanout)]
+        if level == 0:
+            # no parent to attach `_` or `>` to
+            selectors = ['.top%d' % counter[0] if s.startswith(('_', '>')) else s
+                         for s in selectors]
+        pad = '    ' * (indent + 1)
+        body = [pad + properties[i % len(properties)]() for i in xrange(declarations)]
+        if level < depth:
+            body.extend(ruleset(level + 1, indent + 1) for _ in xrange(children))
+        return '%s%s {\n%s\n%s}' % ('    ' * indent, ', '.join(selectors),
+                                    '\n'.join(body), '    ' * indent)
+
+    return '\n'.join(ruleset(0, 0) for _ in xrange(rules)) + '\n'
+
+
+def make_sprite_set(directory, images=100, columns=10, seed=0):
+    """Write `images` PNG files of mixed sizes and a sprite.yaml laying
+    them out in rows of `columns` into `directory`. Returns the YAML path.
+
+    Every fifth row is a nested vertical strip and the first image is
+    repeated, to exercise nested sets and duplicate files.
+    """
+    try:
+        import Image
+    except ImportError:
+        import PIL.Image as Image
+
+    rnd = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    names = []
+    for i in xrange(images):
+        name = 'icon%04d.png' % i
+        size = rnd.choice([(16, 16), (24, 24), (32, 32), (48, 16), (16, 64)])
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256), 255)
+        Image.new('RGBA', size, color).save(os.path.join(directory, name))
+        names.append(name)
+
+    rows = []
+    for start in xrange(0, len(names), columns):
+        row = names[start:start + columns]
+        if len(rows) % 5 == 4:
+            row = [row]
+        rows.append(row)
+    if names:
+        rows.append([names[0]])
+
+    path = os.path.join(directory, 'sprite.yaml')
+    with open(path, 'w') as fp:
+        yaml.safe_dump({'direction': 'vertical', 'images': rows}, fp)
+    return path
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog css|sprite [options] [DIR]')
+    parser.add_option('-n', dest='count', type='int', default=None,
+                      help='top level rules, or images')
+    parser.add_option('-d', dest='depth', type='int', default=2)
+    parser.add_option('-f', dest='fanout', type='int', default=2)
+    parser.add_option('-c', dest='children', type='int', default=1)
+    options, args = parser.parse_args()
+
+    if args[:1] == ['css']:
+        sys.stdout.write(make_stylesheet(options.count or 1000, options.depth,
+                                         options.fanout, options.children))
+    elif args[:1] == ['sprite'] and len(args) == 2:
+        print make_sprite_set(args[1], options.count or 100)
+    else:
+        parser.print_help()
+        parser.exit(2)
+
+
+if __name__ == '__main__':
+    main()
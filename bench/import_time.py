@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Measure how long `import cssc` takes in a fresh interpreter.
+
+Prints the best wall time of N interpreter runs with and without the
+import, then a per-module breakdown in the format of Python 3's
+`-X importtime` (self and cumulative microseconds, nested names indented).
+
+    python bench/import_time.py [-n RUNS] [--module NAME] [--all]
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# run in the child interpreter: time every import done by `import MODULE`
+TRACER = r'''
+import sys, time, __builtin__
+sys.path.insert(0, %(root)r)
+_import = __builtin__.__import__
+stack = []
+records = []
+def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = len(sys.modules)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if len(sys.modules) > before:
+            records.append((len(stack), name, elapsed - children, elapsed))
+__builtin__.__import__ = timed_import
+import %(module)s
+__builtin__.__import__ = _import
+for depth, name, self_time, total in records:
+    sys.stdout.write('import time: %%9d | %%10d | %%s%%s\n' %% (
+        self_time * 1e6, total * 1e6, '  ' * depth, name))
+'''
+
+
+def best_wall_time(code, runs):
+    best = None
+    for _ in xrange(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code])
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='runs', type='int', default=10)
+    parser.add_option('--module', dest='module', default='cssc')
+    parser.add_option('--all', dest='all', default=False, action='store_true',
+                      help='list every module, not only the 20 slowest')
+    options, args = parser.parse_args()
+
+    setup = 'import sys; sys.path.insert(0, %r)' % ROOT
+    empty = best_wall_time(setup, options.runs)
+    loaded = best_wall_time('%s; import %s' % (setup, options.module), options.runs)
+    print 'interpreter start        %8.1f ms' % (empty * 1000)
+    print 'import %-17s %8.1f ms  (+%.1f ms)' % (
+        options.module, loaded * 1000, (loaded - empty) * 1000)
+    print
+
+    output = subprocess.check_output([sys.executable, '-c',
+        TRACER % {'root': ROOT, 'module': options.module}])
+    lines = output.splitlines()
+    if not options.all:
+        lines = sorted(lines, key=lambda l: -int(l.split('|')[1]))[:20]
+    print 'import time: self [us] | cumulative | imported package'
+    for line in lines:
+        print line
+
+
+if __name__ == '__main__':
+    main()
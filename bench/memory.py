@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Memory used by the parsed node tree of a large generated stylesheet.
+
+Parses a document with about N declarations, then copies the tree into
+plain dict-based objects shaped like the nodes before they used
+__slots__ (lists for children, Selector keeping its token list) and
+prints the bytes per node for both. Strings are left out of the per
+node numbers and reported once, for the slotted tree.
+
+    python bench/memory.py [-n DECLARATIONS]
+"""
+
+import os
+import sys
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cssc
+import generate
+
+
+class Legacy(object):
+    """Stand-in for a node with an instance dict."""
+    def __init__(self, kind, **attrs):
+        self.kind = kind
+        self.__dict__.update(attrs)
+
+
+def to_legacy(node):
+    if isinstance(node, cssc.Selector):
+        return Legacy('Selector', tok=list(node.tok))
+    if isinstance(node, cssc.Declaration):
+        return Legacy('Declaration', property=node.property, values=list(node.values))
+    if isinstance(node, cssc.RuleSet):
+        return Legacy('RuleSet',
+                      selectors=[to_legacy(x) for x in node.selectors],
+                      declarations=[to_legacy(x) for x in node.declarations],
+                      child_rules=[to_legacy(x) for x in node.child_rules],
+                      lineno=node.lineno, source=node.source)
+    raise TypeError(node)
+
+
+def node_sizes(roots):
+    """Return {kind: [count, bytes]} for the node objects reachable from
+    `roots`, counting each node with its instance dict and the lists or
+    tuples it holds, plus the total size of the strings they refer to."""
+    sizes = {}
+    strings = {}
+    stack = list(roots)
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Legacy):
+            kind = node.kind
+            attrs = node.__dict__.values()
+            size = sys.getsizeof(node) + sys.getsizeof(node.__dict__)
+        else:
+            kind = type(node).__name__
+            attrs = [getattr(node, name) for name in type(node).__slots__]
+            size = sys.getsizeof(node)
+        for value in attrs:
+            items = [value]
+            if isinstance(value, (list, tuple)):
+                size += sys.getsizeof(value)
+                items = value
+            for item in items:
+                if isinstance(item, basestring):
+                    strings[id(item)] = sys.getsizeof(item)
+                elif isinstance(item, (cssc.Renderable, cssc.Selector, Legacy)):
+                    stack.append(item)
+        entry = sizes.setdefault(kind, [0, 0])
+        entry[0] += 1
+        entry[1] += size
+    return sizes, sum(strings.itervalues())
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='declarations', type='int', default=100000)
+    options, args = parser.parse_args()
+
+    # depth 2 with one child per level: 3 rulesets of 4 declarations per rule
+    text = generate.make_stylesheet(options.declarations // 12 + 1, depth=2,
+                                    fanout=2, children=1, declarations=4)
+    rules = cssc.CSSCParser().parseString(text.decode('utf8'))
+
+    slotted, strings = node_sizes(rules)
+    legacy, _ = node_sizes([to_legacy(rule) for rule in rules])
+
+    print '%-12s %8s %12s %12s %8s' % ('node', 'count', 'dict B/node', 'slots B/node', 'saved')
+    total_legacy = total_slotted = 0
+    for kind in sorted(slotted):
+        count, size = slotted[kind]
+        old = legacy[kind][1]
+        total_legacy += old
+        total_slotted += size
+        print '%-12s %8d %12.1f %12.1f %7.1f%%' % (
+            kind, count, float(old) / count, float(size) / count,
+            100.0 * (old - size) / old)
+    print '%-12s %8s %12.1f %12.1f %7.1f%%' % (
+        'total MB', '', total_legacy / 1e6, total_slotted / 1e6,
+        100.0 * (total_legacy - total_slotted) / total_legacy)
+    print 'strings (shared): %.1f MB' % (strings / 1e6)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compare RuleSet.render(options, output) with write_chunks(iter_render())
+on a large generated rule tree.
+
+    python bench/render.py [-n RULES] [-d DEPTH] [-f FANOUT] [-r REPEAT]
+"""
+
+import os
+import sys
+import time
+import gzip
+import optparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cssc
+import generate
+
+
+class CountingFile(object):
+    def __init__(self, fp):
+        self.fp = fp
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.fp.write(data)
+
+
+def bench(label, func, repeat, compress=False):
+    best = None
+    for _ in xrange(repeat):
+        with tempfile.TemporaryFile() as fp:
+            sink = gzip.GzipFile(fileobj=fp, mode='wb') if compress else fp
+            output = CountingFile(sink)
+            start = time.time()
+            func(output)
+            if compress:
+                sink.close()
+            elapsed = time.time() - start
+            size = fp.tell()
+        best = elapsed if best is None else min(best, elapsed)
+    print '%-36s %8.3fs  %8d writes  %d bytes' % (label, best, output.writes, size)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='rules', type='int', default=5000)
+    parser.add_option('-d', dest='depth', type='int', default=2)
+    parser.add_option('-f', dest='fanout', type='int', default=2)
+    parser.add_option('-r', dest='repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    text = generate.make_stylesheet(options.rules, options.depth, options.fanout)
+    rules = cssc.CSSCParser().parseString(text.decode('utf8'))
+    render_options = optparse.Values({'css3': True})
+
+    def legacy(output):
+        for rule in rules:
+            rule.render(render_options, output)
+
+    def chunked(output):
+        cssc.write_chunks(cssc.iter_rules(rules, render_options), output)
+
+    bench('render(options, output)', legacy, options.repeat)
+    bench('write_chunks(iter_render)', chunked, options.repeat)
+    bench('render(options, output) | gzip', legacy, options.repeat, True)
+    bench('write_chunks(iter_render) | gzip', chunked, options.repeat, True)
+
+
+if __name__ == '__main__':
+    main()
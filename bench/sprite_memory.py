@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Peak memory of SpriteSet.build_image on a large nested sprite definition.
+
+Writes N icons and a YAML nesting them DEPTH levels deep, with a stretch
+fill in every set. Then it builds the atlas in a fresh process, once with
+the current single-canvas build_image and once with a copy of the old
+one, which made an image for every nested set and pasted it into its
+parent. Each run reports how far the peak RSS rose above the RSS just before
+the build, next to the size of the finished RGBA atlas. Needs Linux
+with glibc (/proc/self/status, clear_refs and malloc_trim).
+
+    python bench/sprite_memory.py [-n IMAGES] [-d DEPTH] [-s SIZE]
+"""
+
+import os
+import sys
+import shutil
+import optparse
+import subprocess
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import make_sprite
+from make_sprite import Image
+
+
+def legacy_build_image(sprite):
+    """SpriteSet.build_image before it painted into a single canvas."""
+    if not isinstance(sprite, make_sprite.SpriteSet):
+        return sprite.build_image()
+    image = Image.new('RGBA', sprite.size, 0x000000FF)
+    for child in sprite.sprites:
+        tl = child.topleft
+        t = legacy_build_image(child)
+        if isinstance(t, (tuple, list)):
+            im, sz = t
+        else:
+            im = t
+            sz = child.size
+        image.paste(im, (tl[0], tl[1], tl[0] + sz[0], tl[1] + sz[1]))
+    return image
+
+
+def nest(names, depth, fanout):
+    """Split `names` into `fanout` nested lists, `depth` levels deep, with
+    a stretch fill of the first image at the end of each list."""
+    if depth == 0 or len(names) <= fanout:
+        items = list(names)
+    else:
+        step = (len(names) + fanout - 1) // fanout
+        items = [nest(names[i:i + step], depth - 1, fanout)
+                 for i in xrange(0, len(names), step)]
+    return items + [{'fill': 'stretch', 'image': names[0]}]
+
+
+def make_definition(directory, images, depth, size):
+    names = []
+    for i in xrange(images):
+        name = 'icon%05d.png' % i
+        color = (i * 7 % 256, i * 13 % 256, i * 29 % 256, 255)
+        Image.new('RGBA', (size, size), color).save(os.path.join(directory, name))
+        names.append(name)
+    path = os.path.join(directory, 'nested.yaml')
+    with open(path, 'w') as fp:
+        yaml.safe_dump(nest(names, depth, 4), fp)
+    return path
+
+
+def rss(field):
+    """VmRSS or VmHWM (peak) of this process, in kilobytes."""
+    with open('/proc/self/status') as fp:
+        for line in fp:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+
+
+def reset_peak_rss():
+    # hand memory freed while loading back to the system, or the build can
+    # reuse it without the RSS moving, then start VmHWM again from here
+    import ctypes
+    ctypes.CDLL('libc.so.6').malloc_trim(0)
+    with open('/proc/self/clear_refs', 'w') as fp:
+        fp.write('5')
+
+
+def run(mode, directory, yamlfile):
+    sprite = make_sprite.ImageLoader(directory, jobs=1).load(yamlfile)
+    reset_peak_rss()
+    before = rss('VmRSS')
+    if mode == 'legacy':
+        image = legacy_build_image(sprite)
+    else:
+        image = sprite.build_image()
+    after = rss('VmHWM')
+    print '%d %d %d' % (image.size[0], image.size[1], after - before)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-n', dest='images', type='int', default=2000)
+    parser.add_option('-d', dest='depth', type='int', default=5)
+    parser.add_option('-s', dest='size', type='int', default=32,
+                      help='icon width and height')
+    parser.add_option('--run', dest='run', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.run:
+        run(options.run, args[0], args[1])
+        return
+
+    directory = tempfile.mkdtemp(prefix='cssc-bench-')
+    try:
+        yamlfile = make_definition(directory, options.images, options.depth, options.size)
+        print 'images: %d, depth: %d' % (options.images, options.depth)
+        for mode in ('legacy', 'canvas'):
+            output = subprocess.check_output(
+                [sys.executable, os.path.abspath(__file__), '--run', mode, directory, yamlfile])
+            width, height, rss = map(int, output.split())
+            atlas = width * height * 4 / 1024
+            print '%-8s atlas %dx%d (%d KB), peak rss +%d KB (%.1fx the atlas)' % (
+                mode, width, height, atlas, rss, float(rss) / atlas)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
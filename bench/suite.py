@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Benchmark suite for cssc and make_sprite on generated inputs.
+
+Times CSSCParser.parseString, RuleSet.render, ImageLoader.load and
+SpriteSet.build_image, prints the best of N runs and optionally writes
+the numbers to JSON, so runs from different commits can be compared:
+
+    python bench/suite.py -o before.json
+    git checkout ...
+    python bench/suite.py -o after.json --compare before.json
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import optparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+import cssc
+import make_sprite
+import generate
+
+
+def timeit(func, repeat):
+    times = []
+    for _ in xrange(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {'best': min(times), 'mean': sum(times) / len(times), 'repeat': repeat}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params, repeat, pyparsing=False):
+    results = {}
+    text = generate.make_stylesheet(params['rules'], params['depth'],
+                                    params['fanout'], params['children']).decode('utf8')
+    render_options = optparse.Values({'css3': True})
+
+    def parse():
+        return cssc.CSSCParser().parseString(text)
+    results['parse'] = timeit(parse, repeat)
+    if pyparsing:
+        results['parse_pyparsing'] = timeit(
+            lambda: cssc.CSSCParser(use_pyparsing=True).parseString(text), 1)
+
+    rules = parse()
+    devnull = open(os.devnull, 'wb')
+
+    def render():
+        for rule in rules:
+            rule.render(render_options, devnull)
+    results['render'] = timeit(render, repeat)
+    results['iter_render'] = timeit(
+        lambda: cssc.write_chunks(cssc.iter_rules(rules, render_options), devnull),
+        repeat)
+
+    directory = tempfile.mkdtemp(prefix='cssc-bench-')
+    try:
+        yamlfile = generate.make_sprite_set(directory, params['images'])
+        # a new loader each time; a loader keeps the images it decoded
+        results['sprite_load'] = timeit(
+            lambda: make_sprite.ImageLoader(directory).load(yamlfile), repeat)
+        sprite = make_sprite.ImageLoader(directory).load(yamlfile)
+        results['sprite_build'] = timeit(sprite.build_image, repeat)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def compare(old, new):
+    print
+    print '%-18s %10s %10s %8s' % ('benchmark', 'before', 'after', 'ratio')
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        before = old['results'][name]['best']
+        after = new['results'][name]['best']
+        print '%-18s %9.1fms %9.1fms %7.2fx' % (
+            name, before * 1000, after * 1000, before / after if after else 0)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-o', dest='output', metavar='FILE',
+                      help='write results as JSON')
+    parser.add_option('--compare', dest='compare', metavar='FILE',
+                      help='compare with the results in FILE')
+    parser.add_option('-r', dest='repeat', type='int', default=3)
+    parser.add_option('--rules', dest='rules', type='int', default=1000)
+    parser.add_option('--depth', dest='depth', type='int', default=2)
+    parser.add_option('--fanout', dest='fanout', type='int', default=2)
+    parser.add_option('--children', dest='children', type='int', default=2)
+    parser.add_option('--images', dest='images', type='int', default=200)
+    parser.add_option('--pyparsing', dest='pyparsing', default=False,
+                      action='store_true', help='also time the pyparsing grammar once')
+    options, args = parser.parse_args()
+
+    params = dict((name, getattr(options, name))
+                  for name in ('rules', 'depth', 'fanout', 'children', 'images'))
+    results = run(params, options.repeat, options.pyparsing)
+    data = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': params,
+        'results': results,
+    }
+
+    for name in sorted(results):
+        print '%-18s %9.1fms' % (name, results[name]['best'] * 1000)
+
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump(data, fp, indent=2, sort_keys=True)
+            fp.write('\n')
+
+    if options.compare:
+        with open(options.compare) as fp:
+            old = json.load(fp)
+        if old.get('params') != params:
+            print >>sys.stderr, 'warning: %s was run with %r' % (options.compare, old.get('params'))
+        compare(old, data)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,47 +9,187 @@ Copyright (c) 2010. All rights reserved.
 
 import sys
 import os
-from pyparsing import *
-import jinja2
 import re
+import bisect
+import time
+import contextlib
 import json
+import hashlib
+import cPickle
 
 
-# CCS3
-CCS3_PROPERTIES = set([
-    u'border-radius',
-    u'border-top-left-radius',
-    
-    u'background-size',
-    u'background-clip',
-    u'background-origin',
-    
-    u'text-shadow',
-    u'box-shadow',
-    
-    u'column-count',
-    u'column-gap',
-    u'column-rule',
-    u'column-width',
-])
+# vendor prefixes
+class Prefixer(object):
+    """Expands declarations with vendor prefixes and fallbacks from a table.
+
+    The table maps a property name to a rule such as
+
+        {"when": "css3", "prefixes": ["-moz-", "-webkit-"],
+         "fallbacks": ["filter: alpha(opacity=%(percent)d)"]}
+
+    Each prefix adds the declaration again under `prefix + property`; each
+    fallback is a declaration formatted with `value`, `number` (the value
+    as a float) and `percent` (number * 100, for %d). With "when", the rule
+    only applies while that option is true. The expanded text of a
+    declaration is cached per set of those options; each of those caches
+    is emptied when it reaches `cache_size` entries, so a long running
+    --watch/--serve process or Compiler does not grow without bound.
+    """
+    DEFAULT_TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'prefixes.json')
+
+    def __init__(self, table, cache_size=20000):
+        self.table = table
+        self.cache_size = cache_size
+        self.conditions = sorted(set(rule['when'] for rule in table.itervalues()
+                                     if rule.get('when')))
+        self._cache = {}
+
+    @classmethod
+    def load(cls, path=None):
+        with open(path or cls.DEFAULT_TABLE, 'rb') as fp:
+            return cls(json.load(fp))
+
+    def render(self, property, value, options):
+        """Return the output lines of `property: value` as one string."""
+        return self.render_declarations([Declaration(property, (value,))], options)[0]
+
+    def render_declarations(self, declarations, options):
+        """Return the output text of each of `declarations`."""
+        flags = tuple(bool(getattr(options, name, False)) for name in self.conditions)
+        cache = self._cache.get(flags)
+        if cache is None:
+            cache = self._cache[flags] = {}
+        
+        result = []
+        for dec in declarations:
+            key = (dec.property, dec.value)
+            text = cache.get(key)
+            if text is None:
+                if len(cache) >= self.cache_size:
+                    cache.clear()
+                text = cache[key] = u''.join(self.expand(dec.property, dec.value, options))
+            result.append(text)
+        return result
+
+    def expand(self, property, value, options):
+        yield u'\t%s: %s;\n' % (property, value)
+        
+        rule = self.table.get(property)
+        if not rule or (rule.get('when') and not getattr(options, rule['when'], False)):
+            return
+        for prefix in rule.get('prefixes', ()):
+            yield u'\t%s%s: %s;\n' % (prefix, property, value)
+        if rule.get('fallbacks'):
+            try:
+                number = float(value)
+            except ValueError:
+                # inherit, 50%, var(--x): no numeric fallback to give
+                return
+            fields = {'value': value, 'number': number, 'percent': int(number * 100)}
+            for fallback in rule['fallbacks']:
+                yield u'\t%s;\n' % (fallback % fields)
+
+
+# prefixers by table path, None being the default table; emptied when it
+# holds MAX_PREFIXERS tables
+_prefixers = {}
+MAX_PREFIXERS = 16
+
+def get_prefixer(options):
+    path = getattr(options, 'prefixes', None)
+    prefixer = _prefixers.get(path)
+    if prefixer is None:
+        if len(_prefixers) >= MAX_PREFIXERS:
+            _prefixers.clear()
+        prefixer = _prefixers[path] = Prefixer.load(path)
+    return prefixer
 
 
 # jinja2 
 sprite_coords = {}
 
-def jinja_sprite_background(sprite_name, image_name, repeat='no-repeat'):
-    s = sprite_coords[sprite_name]
-    coord = s['coordinates'][image_name]
-    return 'url(%s) %s -%dpx -%dpx' % (
-        s['url'], repeat, coord[0], coord[1]
-    )
+def make_sprite_background(coords):
+    """Return a sprite_background() for templates that looks sprites up in
+    `coords`, a {name: {'url': ..., 'coordinates': ...}} dict.
+
+    A coordinate is [x, y], or [x, y, info]. info holds the 'page' file of
+    a sprite split into pages, looked up in the sprite's 'pages', and the
+    'size', 'offset' and 'trimmed' size of an image make_sprite.py trimmed.
+    A trimmed image is positioned like any other; give its element the
+    trimmed size with sprite_size(), or the atlas neighbours show through.
+    """
+    def sprite_background(sprite_name, image_name, repeat='no-repeat'):
+        s = coords[sprite_name]
+        coord = s['coordinates'][image_name]
+        info = coord[2] if len(coord) > 2 else {}
+        url = s['url']
+        if 'page' in info:
+            url = s['pages'][info['page']]
+        return 'url(%s) %s -%dpx -%dpx' % (
+            url, repeat, coord[0], coord[1]
+        )
+    return sprite_background
+
+
+def make_sprite_size(coords):
+    """Return a sprite_size() for templates giving the declarations for a
+    trimmed image: `width` and `height` of the trimmed pixels, and a
+    `margin` for the trimmed borders, so the element still takes up the
+    original size."""
+    def sprite_size(sprite_name, image_name):
+        coord = coords[sprite_name]['coordinates'][image_name]
+        if len(coord) < 3 or 'trimmed' not in coord[2]:
+            raise ValueError('no size recorded for %s in %s (build the sprite with trim)'
+                             % (image_name, sprite_name))
+        info = coord[2]
+        (width, height), (x, y), (w, h) = info['size'], info['offset'], info['trimmed']
+        return 'width: %dpx; height: %dpx; margin: %dpx %dpx %dpx %dpx' % (
+            w, h, y, width - x - w, height - y - h, x)
+    return sprite_size
+
+jinja_sprite_background = make_sprite_background(sprite_coords)
+jinja_sprite_size = make_sprite_size(sprite_coords)
 
 
 class Renderable(object):
-    pass
+    """Base of the nodes that produce css.
+
+    render(options, output) writes straight to `output`. iter_render(options)
+    yields unicode chunks instead; pass them to write_chunks() to encode and
+    write them in a few large blocks.
+
+    Nodes use __slots__ and keep their children in tuples; treat them as
+    immutable once built. The optimizer builds new nodes instead.
+    """
+    __slots__ = ()
+
+
+def write_chunks(chunks, output, encoding='utf8', buffer_size=64 * 1024):
+    """Write text `chunks` to `output`, encoding and writing once per
+    `buffer_size` characters."""
+    buf = []
+    size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        size += len(chunk)
+        if size >= buffer_size:
+            output.write(u''.join(buf).encode(encoding))
+            buf = []
+            size = 0
+    if buf:
+        output.write(u''.join(buf).encode(encoding))
+
+
+def iter_rules(rules, options):
+    for rule in rules:
+        for chunk in rule.iter_render(options):
+            yield chunk
 
 
 class Declaration(Renderable):
+    __slots__ = ('property', 'values', 'value')
+    
     @classmethod
     def action(cls, s, loc, tok):
         tokens = tok.asList()
@@ -57,69 +197,98 @@ class Declaration(Renderable):
         
     def __init__(self, property, values):
         self.property = property
-        self.values = values
+        self.values = tuple(values)
+        self.value = ' '.join(self.values)
     
     def clone(self):
-        return Declaration(self.property, self.values[:])
+        return Declaration(self.property, self.values)
     
     def render(self, options, output):
-        s = u'\t%s: %s;\n' % (self.property, ' '.join(self.values))
-        output.write(s.encode('utf8'))
-        
-        if options.css3:
-            if self.property in CCS3_PROPERTIES:
-                output.write('\t-moz-%s: %s;\n' % (self.property, ' '.join(self.values)))
-                output.write('\t-webkit-%s: %s;\n' % (self.property, ' '.join(self.values)))
-        
-        # opacity
-        if self.property == 'opacity':
-            opacity = float(' '.join(self.values))
-            output.write('\tfilter: alpha(opacity=%d);\n' % int(opacity * 100))
-            output.write('\t-moz-opacity: %f;\n' % opacity)
+        for chunk in self.iter_render(options):
+            output.write(chunk.encode('utf8'))
+    
+    def iter_render(self, options):
+        return iter(get_prefixer(options).render_declarations([self], options))
         
     
 class Selector(object):
+    """A selector, joined into its text once when it is parsed."""
+    __slots__ = ('text',)
+    
     @classmethod
     def action(cls, s, loc, tok):
         return cls(tok)
         
     def __init__(self, tok):
-        self.tok = [''.join(x) for x in tok.asList()]
-        self.tok = tok.asList()
+        self.text = ' '.join(tok)
+    
+    @property
+    def tok(self):
+        # simple selectors never contain spaces, so this splits them back
+        return self.text.split(' ')
     
     def __str__(self):
-        return ' '.join(''.join(x) for x in self.tok)
+        return str(self.text)
+    
+    def __unicode__(self):
+        return unicode(self.text)
     
     def __repr__(self):
         return '<Selector (%r)>' % self.tok
 
 
+class SelectorLimitError(Exception):
+    pass
+
+
 class RuleSet(Renderable):
-    def __init__(self, selectors, declarations):
+    __slots__ = ('selectors', 'declarations', 'child_rules', 'lineno', 'source')
+    
+    def __init__(self, selectors, declarations, lineno=None, source=None):
         """docstring for __init__"""
-        self.selectors = selectors
-        self.declarations = []
-        self.child_rules = []
-        
-        for x in declarations:
-            if isinstance(x, Declaration):
-                self.declarations.append(x)
-            if isinstance(x, RuleSet):
-                self.child_rules.append(x)
+        self.selectors = tuple(selectors)
+        self.declarations = tuple(x for x in declarations if isinstance(x, Declaration))
+        self.child_rules = tuple(x for x in declarations if isinstance(x, RuleSet))
+        # where the rule came from, for diagnostics
+        self.lineno = lineno
+        self.source = source
 
     def render(self, options, output):
         return self._render(options, output, [''])
                 
-    def _render(self, options, output, parent_selectors):
+    def expand_selectors(self, parent_selectors, options=None):
+        """Combine every parent selector with every selector of this rule.
+
+        Duplicates are dropped, keeping the first occurrence. When the
+        result is longer than `options.max_selectors` a warning is printed,
+        or SelectorLimitError raised if `options.strict_selectors` is set.
+        """
+        children = [child.text for child in self.selectors]
         selectors = []
+        seen = set()
         for parent in parent_selectors:
-            for child in self.selectors:
-                child = str(child)
+            prefix = parent + u' '
+            for child in children:
                 if child.startswith('_'):
                     s = parent + child[1:]
                 else:
-                    s = ('%s %s' % (parent, child)).strip()
-                selectors.append(s)
+                    s = (prefix + child).strip()
+                if s not in seen:
+                    seen.add(s)
+                    selectors.append(s)
+        
+        limit = getattr(options, 'max_selectors', None)
+        if limit and len(selectors) > limit:
+            message = '%s:%s: `%s` expands to %d selectors (limit %d)' % (
+                self.source or '<string>', self.lineno or '?',
+                u', '.join(children).encode('utf8'), len(selectors), limit)
+            if getattr(options, 'strict_selectors', False):
+                raise SelectorLimitError(message)
+            print >>sys.stderr, 'warning: %s' % message
+        return selectors
+    
+    def _render(self, options, output, parent_selectors):
+        selectors = self.expand_selectors(parent_selectors, options)
         
         output.write(u'%s {\n' % ', '.join(selectors))
         for dec in self.declarations:
@@ -130,6 +299,24 @@ class RuleSet(Renderable):
         for child in self.child_rules:
             child._render(options, output, selectors)
     
+    def iter_render(self, options):
+        return self._iter_render(options, [u''])
+    
+    def _iter_render(self, options, parent_selectors):
+        selectors = self.expand_selectors(parent_selectors, options)
+        
+        # one chunk per rule keeps the generator overhead per rule, not
+        # per declaration
+        chunks = [u'%s {\n' % u', '.join(selectors)]
+        chunks.extend(get_prefixer(options).render_declarations(self.declarations, options))
+        chunks.append(u'}\n')
+        yield u''.join(chunks)
+        
+        # render children
+        for child in self.child_rules:
+            for chunk in child._iter_render(options, selectors):
+                yield chunk
+    
     def __repr__(self):
         return '<RuleSet "%s": %s>' % (', '.join(str(x) for x in self.selectors), self.declarations)
 
@@ -139,8 +326,42 @@ class RuleSet(Renderable):
             for x in child.iter_tree():
                 yield x
 
+    def flatten(self, options, parent_selectors=(u'',)):
+        """Yield this rule and its children as FlatRuleSets, in the order
+        they are rendered."""
+        selectors = self.expand_selectors(parent_selectors, options)
+        yield FlatRuleSet(selectors, self.declarations, self.source, self.lineno)
+        for child in self.child_rules:
+            for x in child.flatten(options, selectors):
+                yield x
+
+
+class FlatRuleSet(Renderable):
+    """A rule whose selectors are already expanded against its parents."""
+    __slots__ = ('selectors', 'declarations', 'source', 'lineno')
+
+    def __init__(self, selectors, declarations, source=None, lineno=None):
+        self.selectors = tuple(selectors)
+        self.declarations = tuple(declarations)
+        self.source = source
+        self.lineno = lineno
+
+    def render(self, options, output):
+        write_chunks(self.iter_render(options), output)
+
+    def iter_render(self, options):
+        chunks = [u'%s {\n' % u', '.join(self.selectors)]
+        chunks.extend(get_prefixer(options).render_declarations(self.declarations, options))
+        chunks.append(u'}\n')
+        yield u''.join(chunks)
+
+    def __repr__(self):
+        return '<FlatRuleSet "%s": %s>' % (', '.join(self.selectors), self.declarations)
+
 
 class Media(Renderable):
+    __slots__ = ('media', 'styles')
+
     @classmethod
     def action(cls, s, loc, tok):
         tokens = tok.asList()
@@ -149,7 +370,7 @@ class Media(Renderable):
 
     def __init__(self, media, styles):
         self.media = media
-        self.styles = styles
+        self.styles = tuple(styles)
 
     def render(self, options, output):
         output.write('@media %s {\n' % self.media)
@@ -158,9 +379,20 @@ class Media(Renderable):
             style.render(options, output)
         
         output.write('}\n\n')
+    
+    def iter_render(self, options):
+        yield u'@media %s {\n' % self.media
+        
+        for style in self.styles:
+            for chunk in style.iter_render(options):
+                yield chunk
+        
+        yield u'}\n\n'
 
 
 class WebkitKeyframes(Renderable):
+    __slots__ = ('name', 'styles')
+
     @classmethod
     def action(cls, s, loc, tok):
         tokens = tok.asList()
@@ -169,7 +401,7 @@ class WebkitKeyframes(Renderable):
 
     def __init__(self, name, styles):
         self.name = name
-        self.styles = styles
+        self.styles = tuple(styles)
 
     def render(self, options, output):
         output.write('@-webkit-keyframes %s {\n' % self.name)
@@ -179,8 +411,19 @@ class WebkitKeyframes(Renderable):
 
         output.write('}\n\n')
 
+    def iter_render(self, options):
+        yield u'@-webkit-keyframes %s {\n' % self.name
+
+        for style in self.styles:
+            for chunk in style.iter_render(options):
+                yield chunk
+
+        yield u'}\n\n'
+
 
 class Keyframe(Renderable):
+    __slots__ = ('frame', 'declarations')
+
     @classmethod
     def action(cls, s, loc, tok):
         tokens = tok.asList()
@@ -188,7 +431,7 @@ class Keyframe(Renderable):
 
     def __init__(self, frame, decs):
         self.frame = frame
-        self.declarations = decs
+        self.declarations = tuple(decs)
 
     def render(self, options, output):
         output.write(self.frame)
@@ -197,8 +440,16 @@ class Keyframe(Renderable):
             dec.render(options, output)
         output.write('}\n')
 
+    def iter_render(self, options):
+        yield u'%s {\n' % self.frame
+        for chunk in get_prefixer(options).render_declarations(self.declarations, options):
+            yield chunk
+        yield u'}\n'
+
 
 class Charset(Renderable):
+    __slots__ = ('charset',)
+
     @classmethod
     def action(cls, s, loc, tok):
         tokens = tok.asList()
@@ -210,99 +461,682 @@ class Charset(Renderable):
     def render(self, options, output):
         output.write('@charset %s;\n' % self.charset)
 
+    def iter_render(self, options):
+        yield u'@charset %s;\n' % self.charset
+
+
+# optimizer
+# shorthands that set properties outside their own family, mapped to one
+# shared family
+PROPERTY_FAMILY_ALIASES = {
+    'line': 'font',     # font sets line-height
+    'columns': 'column',    # columns sets column-width, column-count
+    'gap': 'column',        # gap sets row-gap, column-gap
+    'row': 'column',
+    'grid': 'column',       # grid-gap is the old name of gap
+    'top': 'inset',         # inset sets top, right, bottom, left
+    'right': 'inset',
+    'bottom': 'inset',
+    'left': 'inset',
+    'align': 'place',       # place-* sets align-* and justify-*
+    'justify': 'place',
+}
+
+def property_family(property):
+    """`margin-left` -> `margin`, `-moz-border-radius` -> `border`."""
+    name = property.strip().lower()
+    if name.startswith('-') and name.count('-') >= 2:
+        name = name.split('-', 2)[2]
+    family = name.split('-', 1)[0]
+    return PROPERTY_FAMILY_ALIASES.get(family, family)
+
+
+def flatten_rules(rules, options):
+    """Expand nested RuleSets, also inside @media, into FlatRuleSets."""
+    result = []
+    for rule in rules:
+        if isinstance(rule, RuleSet):
+            result.extend(rule.flatten(options))
+        elif isinstance(rule, Media):
+            result.append(Media(rule.media, flatten_rules(rule.styles, options)))
+        else:
+            result.append(rule)
+    return result
+
+
+def declarations_body(declarations, options, bodies=None):
+    """Render `declarations` to text, reusing the text in `bodies`, a
+    {id(declarations): (declarations, text)} dict, if one is given."""
+    if bodies is not None:
+        entry = bodies.get(id(declarations))
+        if entry is not None and entry[0] is declarations:
+            return entry[1]
+    body = u''.join(get_prefixer(options).render_declarations(declarations, options))
+    if bodies is not None:
+        bodies[id(declarations)] = (declarations, body)
+    return body
+
+
+def rendered_size(rules, options, bodies=None):
+    """Return the number of bytes flattened `rules` render to, taking the
+    declaration text from `bodies` (see declarations_body)."""
+    size = 0
+    for rule in rules:
+        if isinstance(rule, FlatRuleSet):
+            size += len((u'%s {\n' % u', '.join(rule.selectors)).encode('utf8'))
+            size += len(declarations_body(rule.declarations, options, bodies).encode('utf8'))
+            size += 2
+        elif isinstance(rule, Media):
+            size += len((u'@media %s {\n' % rule.media).encode('utf8'))
+            size += rendered_size(rule.styles, options, bodies) + 3
+        else:
+            size += len(u''.join(rule.iter_render(options)).encode('utf8'))
+    return size
+
+
+VENDOR_PSEUDO_RE = re.compile(r'::?-[a-zA-Z]+-[\w-]*')
+
+def vendor_pseudos(selectors):
+    """The vendor-prefixed pseudo classes and elements in `selectors`,
+    like '::-moz-placeholder'."""
+    return frozenset(pseudo.lower() for selector in selectors
+                     for pseudo in VENDOR_PSEUDO_RE.findall(selector))
+
+
+def merge_rules(rules, options, bodies=None):
+    """Drop empty FlatRuleSets and fold rules with the same declarations
+    into the earliest one, as long as no rule in between sets a property
+    of the same family. Anything that is not a FlatRuleSet is a barrier.
+
+    Only rules using the same vendor-prefixed pseudo classes and elements
+    are folded together: a browser drops the whole rule when it does not
+    know one of its selectors.
+    """
+    result = []
+    by_body = {}        # (rendered declarations, vendor prefixes) -> index in result
+    last_family = {}    # property family -> last index in result
+    merged = {}         # index in result -> selectors folded into it
+    barrier = -1
+    for rule in rules:
+        if not isinstance(rule, FlatRuleSet):
+            barrier = len(result)
+            result.append(rule)
+            continue
+        if not rule.declarations:
+            continue
+        
+        body = declarations_body(rule.declarations, options, bodies)
+        families = set(property_family(line.split(':', 1)[0])
+                       for line in body.splitlines())
+        
+        if 'all' in families:
+            # `all` resets every property; nothing may move across it
+            barrier = len(result)
+            result.append(rule)
+            continue
+        
+        key = body, vendor_pseudos(rule.selectors)
+        index = by_body.get(key)
+        if index is not None and index > barrier and \
+                all(last_family.get(f, -1) <= index for f in families):
+            selectors = merged.setdefault(index, list(result[index].selectors))
+            for selector in rule.selectors:
+                if selector not in selectors:
+                    selectors.append(selector)
+            continue
+        
+        index = len(result)
+        result.append(rule)
+        by_body[key] = index
+        for f in families:
+            last_family[f] = index
+    
+    for index, selectors in merged.iteritems():
+        rule = result[index]
+        result[index] = FlatRuleSet(selectors, rule.declarations,
+                                    rule.source, rule.lineno)
+    return result
+
+
+def optimize_rules(rules, options, bodies=None):
+    """Return an optimized copy of the parsed `rules`.
+
+    Nested rules are flattened, empty rules dropped, adjacent @media blocks
+    with the same query merged, and rules with identical declarations
+    grouped where that cannot change the cascade. Pass the `bodies` given
+    to rendered_size() to reuse the declaration text it rendered.
+    """
+    result = []
+    for rule in flatten_rules(rules, options):
+        if isinstance(rule, Media):
+            styles = [x for x in rule.styles
+                      if not isinstance(x, FlatRuleSet) or x.declarations]
+            if not styles:
+                continue
+            if result and isinstance(result[-1], Media) and \
+                    result[-1].media == rule.media:
+                result[-1] = Media(rule.media, result[-1].styles + tuple(styles))
+                continue
+            rule = Media(rule.media, styles)
+        elif isinstance(rule, FlatRuleSet) and not rule.declarations:
+            continue
+        result.append(rule)
+    
+    result = [Media(rule.media, merge_rules(rule.styles, options, bodies))
+              if isinstance(rule, Media) else rule for rule in result]
+    return merge_rules(result, options, bodies)
+
+
+# pruning
+PRUNE_EXTENSIONS = ('.html', '.htm', '.xhtml', '.tmpl', '.tpl', '.jinja',
+                    '.jinja2', '.j2', '.mako', '.php', '.erb')
+
+class SelectorIndex(object):
+    """Class names, ids and tag names used by a set of HTML or template
+    files, for pruning rules that cannot match any of them.
+
+    Names matching one of the `whitelist` glob patterns (for classes added
+    by scripts, say) always count as used, as do the tags an HTML parser
+    adds on its own even when the source leaves them out.
+    """
+    IMPLIED_TAGS = ('html', 'head', 'body', 'tbody')
+    TAG_RE = re.compile(r'<([a-zA-Z][\w-]*)')
+    ATTR_RE = re.compile(r'''\b(class|id)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))''', re.I)
+    TEMPLATE_RE = re.compile(r'\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}|<%.*?%>|<\?.*?\?>', re.S)
+    
+    def __init__(self, whitelist=()):
+        self.classes = set()
+        self.ids = set()
+        self.tags = set(self.IMPLIED_TAGS)
+        self.files = 0
+        self.whitelist = None
+        if whitelist:
+            import fnmatch
+            self.whitelist = re.compile('|'.join(fnmatch.translate(x) for x in whitelist))
+    
+    def add_text(self, text):
+        self.tags.update(x.lower() for x in self.TAG_RE.findall(text))
+        for name, dquoted, squoted, unquoted in self.ATTR_RE.findall(text):
+            # template tags inside the value are dynamic; keep the static words
+            words = self.TEMPLATE_RE.sub(' ', dquoted or squoted or unquoted).split()
+            if name.lower() == 'class':
+                self.classes.update(words)
+            else:
+                self.ids.update(words)
+        self.files += 1
+    
+    def add_directory(self, directory, extensions=PRUNE_EXTENSIONS):
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                if os.path.splitext(filename)[1].lower() in extensions:
+                    with open(os.path.join(dirpath, filename)) as fp:
+                        self.add_text(fp.read().decode('utf8', 'replace'))
+    
+    def _used(self, name, names):
+        return name in names or bool(self.whitelist and self.whitelist.match(name))
+    
+    def can_match(self, selector):
+        """False if `selector` needs a class, id or tag that is not used.
+        Anything it cannot understand is assumed to match."""
+        # drop arguments (:not(.x)), attribute selectors and pseudo classes
+        text = selector
+        while '(' in text:
+            stripped = re.sub(r'\([^()]*\)', '', text)
+            if stripped == text:
+                return True
+            text = stripped
+        text = re.sub(r'\[[^\]]*\]', '', text)
+        text = re.sub(r'::?[\w-]+', '', text)
+        
+        for compound in re.split(r'[\s>+~]+', text):
+            tag = re.match(r'[a-zA-Z][\w-]*', compound)
+            if tag and not self._used(tag.group().lower(), self.tags):
+                return False
+            for name in re.findall(r'\.([\w-]+)', compound):
+                if not self._used(name, self.classes):
+                    return False
+            for name in re.findall(r'#([\w-]+)', compound):
+                if not self._used(name, self.ids):
+                    return False
+        return True
+
+
+def prune_rules(rules, index, options):
+    """Flatten `rules` and drop the selectors that cannot match anything in
+    `index`, and the rules left without selectors.
+
+    Returns (rules, removed rules, removed selectors).
+    """
+    result = []
+    removed_rules = removed_selectors = 0
+    for rule in flatten_rules(rules, options):
+        if isinstance(rule, FlatRuleSet):
+            selectors = [x for x in rule.selectors if index.can_match(x)]
+            removed_selectors += len(rule.selectors) - len(selectors)
+            if not selectors:
+                removed_rules += 1
+                continue
+            if len(selectors) != len(rule.selectors):
+                rule = FlatRuleSet(selectors, rule.declarations, rule.source, rule.lineno)
+        elif isinstance(rule, Media):
+            styles, rules_, selectors_ = prune_rules(rule.styles, index, options)
+            removed_rules += rules_
+            removed_selectors += selectors_
+            if not styles:
+                continue
+            rule = Media(rule.media, styles)
+        result.append(rule)
+    return result, removed_rules, removed_selectors
+
+
+###
+class ParseError(Exception):
+    """Syntax error raised by CSSCParser.
+
+    Has the same attributes as pyparsing's ParseException, so errors from
+    both parser implementations can be reported the same way.
+    """
+    def __init__(self, pstr, loc, msg):
+        # keep all arguments in self.args so the error survives pickling
+        # on its way back from a -j worker
+        Exception.__init__(self, pstr, loc, msg)
+        self.pstr = pstr
+        self.loc = loc
+        self.msg = msg
+
+    @property
+    def lineno(self):
+        return self.pstr.count('\n', 0, self.loc) + 1
+
+    @property
+    def col(self):
+        if 0 < self.loc < len(self.pstr) and self.pstr[self.loc - 1] == '\n':
+            return 1
+        return self.loc - self.pstr.rfind('\n', 0, self.loc)
+    column = col
+
+    @property
+    def line(self):
+        start = self.pstr.rfind('\n', 0, self.loc) + 1
+        end = self.pstr.find('\n', self.loc)
+        if end < 0:
+            end = len(self.pstr)
+        return self.pstr[start:end]
+
+    def markInputline(self, markerString='>!<'):
+        line_str = self.line
+        if markerString:
+            line_column = self.col - 1
+            line_str = ''.join((line_str[:line_column], markerString, line_str[line_column:]))
+        return line_str.strip()
+
+    def __str__(self):
+        return '%s (at char %d), (line:%d, col:%d)' % (self.msg, self.loc, self.lineno, self.col)
+
+
+class CSSCRecursiveParser(object):
+    """Hand written parser for the CSSC grammar.
+
+    Accepts the same language as the pyparsing grammar of CSSCParser and
+    builds the same node objects. Tokens are matched on demand while the
+    text is walked once; whitespace and comments are skipped in front of
+    every token, like pyparsing's ignore() does.
+
+    Every _parse_* method takes a position and returns a (result, position)
+    tuple, or None when the construct does not match there.
+    """
+    IGNORABLE = re.compile(r'(?:[ \t\r\n]+|/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|//[^\n]*(?:\\\n[^\n]*)*)+')
+    IDENT = re.compile(r'[a-z0-9_.+-]+(\s+[a-z0-9_.+-]+)*', re.I)
+    STRING = re.compile(r'"(?:[^"\n\r\\]|""|\\(?:[^x]|x[0-9a-fA-F]+))*"|' +
+                        r"'(?:[^'\n\r\\]|''|\\(?:[^x]|x[0-9a-fA-F]+))*'")
+    COMBINATOR = re.compile(r'(\+|>\s+)')
+    SIMPLE_SELECTOR = re.compile(r'''\*|(_?[a-z0-9#:_=\[\]\-\."]+)|_''', re.I)
+    VALUE = re.compile(r'[^;]+')
+    PRELUDE = re.compile(r'[^{]+')
+    FRAME = re.compile(r'from|to|\d+%')
+
+    def parseString(self, txt, source=None):
+        # pyparsing expands tabs before parsing, which shows up both in
+        # declaration values and in error positions.
+        txt = self.txt = txt.expandtabs()
+        self.source = source
+        self.newlines = [m.start() for m in re.finditer('\n', txt)]
+        self.names = {}
+        rules = []
+        pos = 0
+        end = len(txt)
+        while True:
+            pos = self._skip(pos)
+            if pos >= end:
+                break
+            result = self._parse_toplevel(pos)
+            if result is None:
+                # pyparsing stops its top level ZeroOrMore here and fails
+                # at the end-of-text check; report the same position.
+                raise ParseError(txt, pos, 'Expected end of text')
+            rule, pos = result
+            rules.append(rule)
+        return rules
+
+    # tokens
+    def _skip(self, pos):
+        m = self.IGNORABLE.match(self.txt, pos)
+        if m:
+            return m.end()
+        return pos
+
+    def _literal(self, pos, lit):
+        pos = self._skip(pos)
+        if self.txt.startswith(lit, pos):
+            return pos + len(lit)
+        return None
+
+    def _token(self, pos, rex):
+        m = rex.match(self.txt, self._skip(pos))
+        if m:
+            return m.group(0), m.end()
+        return None
+
+    # grammar
+    def _parse_toplevel(self, pos):
+        txt = self.txt
+        if txt.startswith('@charset', pos):
+            return self._parse_charset(pos)
+        if txt.startswith('@media', pos):
+            return self._parse_media(pos)
+        if txt.startswith('@-webkit-keyframes', pos):
+            return self._parse_webkit_keyframes(pos)
+        return self._parse_ruleset(pos)
+
+    def _parse_charset(self, pos):
+        result = self._token(pos + len('@charset'), self.STRING)
+        if result is None:
+            return None
+        charset, pos = result
+        pos = self._literal(pos, ';')
+        if pos is None:
+            return None
+        return Charset(charset), pos
+
+    def _parse_media(self, pos):
+        result = self._token(pos + len('@media'), self.PRELUDE)
+        if result is None:
+            return None
+        media, pos = result
+        pos = self._literal(pos, '{')
+        if pos is None:
+            return None
+
+        styles = []
+        while True:
+            result = self._parse_ruleset(self._skip(pos))
+            if result is None:
+                break
+            rule, pos = result
+            styles.append(rule)
+
+        pos = self._literal(pos, '}')
+        if pos is None:
+            return None
+        return Media(media.rstrip(), styles), pos
+
+    def _parse_webkit_keyframes(self, pos):
+        result = self._token(pos + len('@-webkit-keyframes'), self.PRELUDE)
+        if result is None:
+            return None
+        name, pos = result
+        pos = self._literal(pos, '{')
+        if pos is None:
+            return None
+
+        styles = []
+        while True:
+            result = self._parse_keyframe(pos)
+            if result is None:
+                break
+            frame, pos = result
+            styles.append(frame)
+
+        pos = self._literal(pos, '}')
+        if pos is None:
+            return None
+        return WebkitKeyframes(name.rstrip(), styles), pos
+
+    def _parse_keyframe(self, pos):
+        result = self._token(pos, self.FRAME)
+        if result is None:
+            return None
+        frame, pos = result
+        pos = self._literal(pos, '{')
+        if pos is None:
+            return None
+
+        decs = []
+        while True:
+            result = self._parse_declaration(self._skip(pos))
+            if result is None:
+                break
+            dec, pos = result
+            decs.append(dec)
+            while True:
+                next_pos = self._literal(pos, ';')
+                if next_pos is None:
+                    break
+                pos = next_pos
+
+        pos = self._literal(pos, '}')
+        if pos is None:
+            return None
+        return Keyframe(frame, decs), pos
+
+    def _parse_selector(self, pos):
+        tok = []
+        while True:
+            p = self._skip(pos)
+            combinator = self.COMBINATOR.match(self.txt, p)
+            if combinator:
+                p = self._skip(combinator.end())
+            simple = self.SIMPLE_SELECTOR.match(self.txt, p)
+            if not simple:
+                break
+            if combinator:
+                tok.append(combinator.group(0)[0])
+            tok.append(simple.group(0))
+            pos = simple.end()
+
+        if not tok:
+            return None
+        return Selector(tok), pos
+
+    def _parse_ruleset(self, pos):
+        start = pos
+        result = self._parse_selector(pos)
+        if result is None:
+            return None
+        selector, pos = result
+        selectors = [selector]
+        while True:
+            p = self._literal(pos, ',')
+            if p is None:
+                break
+            result = self._parse_selector(p)
+            if result is None:
+                break
+            selector, pos = result
+            selectors.append(selector)
+
+        pos = self._literal(pos, '{')
+        if pos is None:
+            return None
+
+        declarations = []
+        while True:
+            p = self._skip(pos)
+            result = self._parse_ruleset(p)
+            if result is None:
+                result = self._parse_declaration(p)
+                if result is None:
+                    break
+            item, pos = result
+            declarations.append(item)
+
+        pos = self._literal(pos, '}')
+        if pos is None:
+            return None
+        return RuleSet(selectors, declarations,
+                       bisect.bisect_left(self.newlines, start) + 1, self.source), pos
+
+    def _parse_declaration(self, pos):
+        m = self.IDENT.match(self.txt, pos)
+        if not m:
+            return None
+        pos = self._literal(m.end(), ':')
+        if pos is None:
+            return None
+        result = self._token(pos, self.VALUE)
+        if result is None:
+            return None
+        value, pos = result
+        pos = self._literal(pos, ';')
+        if pos is None:
+            return None
+        # property names repeat a lot; keep one string object per name
+        property = self.names.setdefault(m.group(0), m.group(0))
+        return Declaration(property, (value,)), pos
+
 
 ###
+def _build_pyparsing_grammar():
+    """Build the pyparsing grammar of CSSC.
+
+    Called on first use by CSSCParser.grammar(), so that importing cssc
+    neither imports pyparsing nor constructs the grammar.
+    """
+    from pyparsing import Regex, quotedString, OneOrMore, Optional, \
+        ZeroOrMore, Group, Suppress, Forward, Literal, cppStyleComment, \
+        lineno
+    
+    class PyparsingGrammar(object):
+        # file name given to the RuleSets; set by CSSCParser.parseString
+        source = None
+        
+        rex = {
+            'nmstart':  '[a-z\200-\377]',
+            'nmchar':   '[a-z0-9-\200-\377]'
+        }
+        #IDENT = ident = Regex('%(nmstart)s%(nmchar)s*' % rex, re.I)
+        #IDENT = Regex(r'[a-z0-9_.+-]+', re.I)
+        IDENT = Regex(r'[a-z0-9_.+-]+(\s+[a-z0-9_.+-]+)*', re.I)
+        STRING = quotedString
+        HASH = Regex('#%(nmchar)s*' % rex, re.I)
+        URI = Regex(r'url\(\s*([^\s)]*)\s*\)')
+    
+        combinator = Regex(r'(\+|>\s+)')# oneOf("+ >")
+        def combinator_action(s, loc, tok):
+            return tok.asList()[0][0]
+        combinator.setParseAction(combinator_action)
+        
+        simple_selector = Regex(r'''\*|(_?[a-z0-9#:_=\[\]\-\."]+)|_''', re.I)
+        selector = OneOrMore(Optional(combinator) + simple_selector)
+        selector.setName('selector')
+        selector.setParseAction(Selector.action)
+
+        selectors = Group(selector + ZeroOrMore(Suppress(",") + selector))
+        selectors.setName('selectors')
+    
+        #variable = Suppress('{{') + IDENT + Suppress('}}')
+    
+        VALUE = Regex(r'(-|\+)?(\d*\.\d+|\d+)(em|ex|px|cm|mm|in|pt|pc|deg|rad|grad|ms|s|Hz|kHz|%)?(/(-|\+)?(\d*\.\d+|\d+)(em|ex|px|cm|mm|in|pt|pc|deg|rad|grad|ms|s|Hz|kHz|%))?', re.I)
+        property_ = IDENT
+        term = Forward()
+        FUNCTION = IDENT + Suppress('(') + term + ZeroOrMore(Suppress(',') + term) + Suppress(')')
+        term << (VALUE | URI | HASH | FUNCTION | STRING | IDENT)
+        prio = Regex('!\\s*important', re.I)
+    
+        ruleset = Forward()
+    
+        def function_action(s, loc, tok):
+            tok = tok.asList()
+            return '%s(%s)' % (tok[0], ', '.join(tok[1:]))
+        FUNCTION.setParseAction(function_action)
+    
+        declaration = property_ + Suppress(':') + Regex('[^;]+') + Suppress(';')
+        declaration.setParseAction(Declaration.action)
+    
+        declarations = Group(ZeroOrMore(ruleset | declaration))
+        declarations.setName('declarations')
+    
+        ruleset << selectors + Suppress("{") + declarations + Suppress("}")
+        ruleset.setName('ruleset')
+
+        def ruleset_action(s, loc, tok):
+            selectors, declarations = tok.asList()
+            return RuleSet(selectors, declarations, lineno(loc, s),
+                           PyparsingGrammar.source)
+        ruleset.setParseAction(ruleset_action)
+    
+        # @charset
+        charset = Literal('@charset').suppress() + STRING + Literal(';').suppress()
+        charset.setParseAction(Charset.action).setName('@charset')
+
+        # @media
+        media = Literal('@media').suppress() + Regex(r'[^{]+') + Suppress("{") + ZeroOrMore(ruleset) + Suppress("}")
+        media.setParseAction(Media.action).setName('media')
+        media.setName('@media')
+    
+        # @-webkit-keyframes
+        frame_identifier = Regex('from|to|\d+%')
+        keyframe = frame_identifier + Suppress('{') + \
+            Group(ZeroOrMore(declaration + ZeroOrMore(Suppress(';')))) + \
+            Suppress('}')
+        keyframe.setParseAction(Keyframe.action)
+    
+        webkit_keyframes = Literal('@-webkit-keyframes').suppress() + Regex(r'[^{]+') + Suppress("{") + ZeroOrMore(keyframe) + Suppress("}")
+        webkit_keyframes.setParseAction(WebkitKeyframes.action).setName('webkit_keyframes')
+        webkit_keyframes.setName('@-webkit-keyframes')
+    
+        cssc = ZeroOrMore(charset | media | webkit_keyframes | ruleset)
+        cssc.setName('cssc')
+        comments = cppStyleComment
+        cssc.ignore(comments)
+    
+        # deprecated
+        css = cssc
+    
+    return PyparsingGrammar
+
+
 class CSSCParser(object):
-    rex = {
-        'nmstart':  '[a-z\200-\377]',
-        'nmchar':   '[a-z0-9-\200-\377]'
-    }
-    #IDENT = ident = Regex('%(nmstart)s%(nmchar)s*' % rex, re.I)
-    #IDENT = Regex(r'[a-z0-9_.+-]+', re.I)
-    IDENT = Regex(r'[a-z0-9_.+-]+(\s+[a-z0-9_.+-]+)*', re.I)
-    STRING = quotedString
-    HASH = Regex('#%(nmchar)s*' % rex, re.I)
-    URI = Regex(r'url\(\s*([^\s)]*)\s*\)')
-    
-    combinator = Regex(r'(\+|>\s+)')# oneOf("+ >")
-    def combinator_action(s, loc, tok):
-        return tok.asList()[0][0]
-    combinator.setParseAction(combinator_action)
-        
-    simple_selector = Regex(r'''\*|(_?[a-z0-9#:_=\[\]\-\."]+)|_''', re.I)
-    selector = OneOrMore(Optional(combinator) + simple_selector)
-    selector.setName('selector')
-    selector.setParseAction(Selector.action)
-
-    selectors = Group(selector + ZeroOrMore(Suppress(",") + selector))
-    selectors.setName('selectors')
-    
-    #variable = Suppress('{{') + IDENT + Suppress('}}')
-    
-    VALUE = Regex(r'(-|\+)?(\d*\.\d+|\d+)(em|ex|px|cm|mm|in|pt|pc|deg|rad|grad|ms|s|Hz|kHz|%)?(/(-|\+)?(\d*\.\d+|\d+)(em|ex|px|cm|mm|in|pt|pc|deg|rad|grad|ms|s|Hz|kHz|%))?', re.I)
-    property_ = IDENT
-    term = Forward()
-    FUNCTION = IDENT + Suppress('(') + term + ZeroOrMore(Suppress(',') + term) + Suppress(')')
-    term << (VALUE | URI | HASH | FUNCTION | STRING | IDENT)
-    prio = Regex('!\\s*important', re.I)
-    
-    ruleset = Forward()
-    
-    def function_action(s, loc, tok):
-        tok = tok.asList()
-        return '%s(%s)' % (tok[0], ', '.join(tok[1:]))
-    FUNCTION.setParseAction(function_action)
-    
-    declaration = property_ + Suppress(':') + Regex('[^;]+') + Suppress(';')
-    declaration.setParseAction(Declaration.action)
-    
-    declarations = Group(ZeroOrMore(ruleset | declaration))
-    declarations.setName('declarations')
-    
-    ruleset << selectors + Suppress("{") + declarations + Suppress("}")
-    ruleset.setName('ruleset')
-
-    def ruleset_action(s, loc, tok):
-        selectors, declarations = tok.asList()
-        return RuleSet(selectors, declarations)
-    ruleset.setParseAction(ruleset_action)
-    
-    # @charset
-    charset = Literal('@charset').suppress() + STRING + Literal(';').suppress()
-    charset.setParseAction(Charset.action).setName('@charset')
-
-    # @media
-    media = Literal('@media').suppress() + Regex(r'[^{]+') + Suppress("{") + ZeroOrMore(ruleset) + Suppress("}")
-    media.setParseAction(Media.action).setName('media')
-    media.setName('@media')
-    
-    # @-webkit-keyframes
-    frame_identifier = Regex('from|to|\d+%')
-    keyframe = frame_identifier + Suppress('{') + \
-        Group(ZeroOrMore(declaration + ZeroOrMore(Suppress(';')))) + \
-        Suppress('}')
-    keyframe.setParseAction(Keyframe.action)
-    
-    webkit_keyframes = Literal('@-webkit-keyframes').suppress() + Regex(r'[^{]+') + Suppress("{") + ZeroOrMore(keyframe) + Suppress("}")
-    webkit_keyframes.setParseAction(WebkitKeyframes.action).setName('webkit_keyframes')
-    webkit_keyframes.setName('@-webkit-keyframes')
-    
-    cssc = ZeroOrMore(charset | media | webkit_keyframes | ruleset)
-    cssc.setName('cssc')
-    comments = cppStyleComment
-    cssc.ignore(comments)
-    
-    # deprecated
-    css = cssc
-    
-    def __init__(self):
-        """docstring for __init__"""
-        pass
+    _grammar = None
+    
+    @classmethod
+    def grammar(cls):
+        """The pyparsing grammar, built on first use."""
+        if cls._grammar is None:
+            cls._grammar = _build_pyparsing_grammar()
+        return cls._grammar
     
-    def parseString(self, txt):
-        """docstring for parseString"""
-        import pprint
-        results = self.cssc.parseString(txt, parseAll=True)
+    def __init__(self, use_pyparsing=False):
+        """Parse with the pyparsing grammar below instead of
+        CSSCRecursiveParser when `use_pyparsing` is true."""
+        self.use_pyparsing = use_pyparsing
+    
+    def parseString(self, txt, source=None):
+        """Parse `txt` into a list of rules. `source`, the name of the file
+        it came from, is recorded on every RuleSet."""
+        if not self.use_pyparsing:
+            return CSSCRecursiveParser().parseString(txt, source)
+        
+        from pyparsing import ParseException
+        
+        grammar = self.grammar()
+        grammar.source = source
+        try:
+            results = grammar.cssc.parseString(txt, parseAll=True)
+        except ParseException, exc:
+            raise ParseError(exc.pstr, exc.loc, exc.msg)
+        finally:
+            grammar.source = None
         return results.asList()
     
     def parseFile(self, fp):
@@ -310,9 +1144,80 @@ class CSSCParser(object):
         return self.parseString(fo.read())
 
 
+class ParseCache(object):
+    """On-disk cache of parsed rule trees.
+
+    Entries are pickled rule lists stored under the SHA-1 of the rendered
+    stylesheet text and the file name recorded in its rules, so an
+    unchanged input skips parsing completely.
+    `evict()` removes the least recently used entries until the directory
+    is no larger than `max_size` bytes.
+    """
+    # bump whenever the node classes change shape
+    VERSION = 5
+    SUFFIX = '.pickle'
+
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, txt, source=None):
+        if isinstance(txt, unicode):
+            txt = txt.encode('utf8')
+        if isinstance(source, unicode):
+            source = source.encode('utf8')
+        return hashlib.sha1('%d\0%s\0%s' % (self.VERSION, source or '', txt)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, txt, source=None):
+        """Return the cached rules for `txt` parsed as `source`, or None."""
+        path = self.path(self.key(txt, source))
+        try:
+            with open(path, 'rb') as fp:
+                rules = cPickle.load(fp)
+        except Exception:
+            # missing, truncated or written by an incompatible version
+            return None
+        # the mtime is the LRU timestamp
+        os.utime(path, None)
+        return rules
+
+    def set(self, txt, rules, source=None):
+        import tempfile
+        
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fp:
+            cPickle.dump(rules, fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, self.path(self.key(txt, source)))
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
+
+
 # TEST
-cls = CSSCParser
 def test():
+    from pyparsing import ParseException, lineno, col
+    cls = CSSCParser.grammar()
+    
     def t(g, t, s, parseAll=True):
         try:
             print '%r == %r' % (t.parseString(s, parseAll=parseAll), g)
@@ -379,6 +1284,736 @@ def test():
 
 
 ### 
+def load_variables(path):
+    variables = {}
+    with open(path, 'rb') as fp:
+        for k, v in json.load(fp).iteritems():
+            if isinstance(k, unicode):
+                k = k.encode('utf8')
+            variables[k] = v
+    return variables
+
+
+def page_url(url, page):
+    """URL of the `page` file of a sprite split by make_sprite.py: `{page}`
+    in `url` is replaced by the file name, else its last segment is."""
+    if '{page}' in url:
+        return url.replace('{page}', page)
+    return url.rsplit('/', 1)[0] + '/' + page if '/' in url else page
+
+
+def read_coords(coords_defs):
+    """Read sprite coordinates given as `JSON_FILE,URL` pairs."""
+    coords = {}
+    for coords_def in coords_defs:
+        coords_name, url = coords_def.split(',', 1)
+        key = os.path.splitext(os.path.basename(coords_name))[0]
+        coordinates = json.load(open(coords_name, 'r'))
+        pages = {}
+        for coord in coordinates.itervalues():
+            if len(coord) > 2 and 'page' in coord[2]:
+                page = coord[2]['page']
+                pages[page] = page_url(url, page)
+        coords[key] = {
+            'url': url,
+            'coordinates': coordinates,
+            'pages': pages,
+        }
+    return coords
+
+
+def load_coords(coords_defs):
+    """Load sprite coordinates into the module wide registry."""
+    sprite_coords.update(read_coords(coords_defs))
+
+
+# shared environments, by (search path, bytecode cache directory)
+_environments = {}
+
+def create_environment(paths, template_cache=None):
+    """Return the Jinja environment for templates next to `paths`.
+
+    One environment is shared by every call with the same directories, so
+    templates compiled once stay compiled for the life of the process. With
+    `template_cache`, compiled templates are also kept in that directory;
+    Jinja stores them with a checksum of their source and recompiles a
+    template when it no longer matches.
+    """
+    searchpath = []
+    for path in paths:
+        dirname = os.path.dirname(path)
+        if dirname not in searchpath:
+            searchpath.append(dirname)
+    
+    key = (tuple(searchpath), template_cache)
+    env = _environments.get(key)
+    if env is None:
+        env = _environments[key] = new_environment(searchpath, template_cache,
+                                                   jinja_sprite_background,
+                                                   jinja_sprite_size)
+    return env
+
+
+def new_environment(searchpath, template_cache=None, sprite_background=None,
+                    sprite_size=None):
+    """Build a Jinja environment loading templates from `searchpath`."""
+    import jinja2
+    
+    bytecode_cache = None
+    if template_cache:
+        if not os.path.isdir(template_cache):
+            os.makedirs(template_cache)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(template_cache)
+    
+    loader = jinja2.FileSystemLoader(searchpath)
+    env = jinja2.Environment(loader=loader,
+        extensions=['jinja2.ext.ExprStmtExtension'],
+        bytecode_cache=bytecode_cache, auto_reload=True)
+    env.globals.update({
+        'sprite_background': sprite_background or jinja_sprite_background,
+        'sprite_size': sprite_size or jinja_sprite_size,
+    })
+    return env
+
+
+class FileStats(object):
+    """Timings and counts of one input, collected for --stats."""
+    PHASES = ('template', 'parse', 'optimize', 'render')
+    COUNTS = ('rulesets', 'declarations', 'selectors', 'media', 'bytes')
+
+    def __init__(self, path, profiler=None):
+        self.path = path
+        self.profiler = profiler
+        self.cached = False
+        self.times = {}
+        self.counts = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        profiler = self.profiler if name == 'parse' else None
+        start = time.time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+            self.times[name] = self.times.get(name, 0.0) + time.time() - start
+
+    def count_rules(self, rules):
+        counts = dict.fromkeys(('rulesets', 'declarations', 'selectors', 'media'), 0)
+        for rule in rules:
+            styles = [rule]
+            if isinstance(rule, Media):
+                counts['media'] += 1
+                styles = rule.styles
+            elif isinstance(rule, WebkitKeyframes):
+                for frame in rule.styles:
+                    counts['declarations'] += len(frame.declarations)
+            for style in styles:
+                if isinstance(style, RuleSet):
+                    # no options: count without the --max-selectors warnings
+                    for flat in style.flatten(None):
+                        counts['rulesets'] += 1
+                        counts['declarations'] += len(flat.declarations)
+                        counts['selectors'] += len(flat.selectors)
+        for key, value in counts.iteritems():
+            self.counts[key] = self.counts.get(key, 0) + value
+
+    def __getstate__(self):
+        # profilers do not pickle; -j workers never profile anyway
+        state = self.__dict__.copy()
+        state['profiler'] = None
+        return state
+
+    def as_dict(self):
+        result = {'path': self.path, 'cached': self.cached}
+        for name in self.PHASES:
+            result[name] = self.times.get(name)
+        for name in self.COUNTS:
+            result[name] = self.counts.get(name)
+        return result
+
+
+class BuildStats(object):
+    """FileStats of every input plus the whole-build phases, and the
+    cProfile data of all parse phases when `profile` is true."""
+    def __init__(self, profile=False):
+        self.files = []
+        self.total = FileStats('total')
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def add_file(self, path):
+        stats = FileStats(path, self.profiler)
+        self.files.append(stats)
+        return stats
+
+    def as_dict(self):
+        total = self.total.as_dict()
+        for stats in self.files:
+            for name, value in stats.times.items() + stats.counts.items():
+                total[name] = (total[name] or 0) + value
+        del total['cached']
+        return {'files': [stats.as_dict() for stats in self.files], 'total': total}
+
+    def format_text(self):
+        data = self.as_dict()
+        row_format = '%-24s' + ' %12s' * len(FileStats.PHASES + FileStats.COUNTS)
+        lines = [row_format % (('file',) + FileStats.PHASES + FileStats.COUNTS)]
+        for row in data['files'] + [data['total']]:
+            path = row['path']
+            if row.get('cached'):
+                path += ' (cached)'
+            cells = [path]
+            for name in FileStats.PHASES:
+                value = row[name]
+                cells.append('-' if value is None else '%.1fms' % (value * 1000))
+            for name in FileStats.COUNTS:
+                value = row[name]
+                cells.append('-' if value is None else str(value))
+            lines.append(row_format % tuple(cells))
+        return '\n'.join(lines)
+
+    def dump_json(self, fp):
+        json.dump(self.as_dict(), fp, indent=2, sort_keys=True)
+        fp.write('\n')
+
+
+@contextlib.contextmanager
+def _no_phase(name):
+    yield
+
+
+def compile_path(env, parser, path, variables, cache=None, stats=None):
+    """Render the template at `path` and return its parsed rules.
+
+    Phase timings and rule counts are recorded into the FileStats `stats`.
+    """
+    phase = stats.phase if stats else _no_phase
+    
+    with phase('template'):
+        t = env.get_template(os.path.basename(path))
+        cssbody = t.render(variables)
+    
+    with phase('parse'):
+        parsed = cache.get(cssbody, path) if cache else None
+        if parsed is not None:
+            if stats:
+                stats.cached = True
+        else:
+            try:
+                parsed = parser.parseString(cssbody, path)
+            except ParseError, exc:
+                print >>sys.stderr, 'exception at : `%s`' % exc.markInputline('').encode('utf8')
+                raise
+            if cache:
+                cache.set(cssbody, parsed, path)
+    
+    if stats:
+        stats.count_rules(parsed)
+    return parsed
+
+
+# state of a -j worker process, set up by _init_worker
+_worker = None
+
+def _init_worker(paths, variables, coords, use_pyparsing, cache_dir, cache_size,
+                 template_cache, collect_stats):
+    global _worker
+    # everything the worker needs comes in through the arguments, so this
+    # does not depend on the pool forking from an initialised parent
+    coords = dict(coords)
+    sprite_coords.clear()
+    sprite_coords.update(coords)
+    
+    cache = None
+    if cache_dir:
+        cache = ParseCache(cache_dir, cache_size)
+    _worker = (create_environment(paths, template_cache), CSSCParser(use_pyparsing),
+               variables, cache, collect_stats)
+
+
+def _compile_in_worker(path):
+    env, parser, variables, cache, collect_stats = _worker
+    if not collect_stats:
+        return compile_path(env, parser, path, variables, cache)
+    stats = FileStats(path)
+    return compile_path(env, parser, path, variables, cache, stats), stats
+
+
+def compile_paths_parallel(paths, variables, coords, jobs,
+                           use_pyparsing=False, cache_dir=None, cache_size=0,
+                           template_cache=None, collect_stats=False):
+    """Render and parse `paths` in `jobs` worker processes.
+
+    Returns one rule list per path, in the order of `paths`, or one
+    (rules, FileStats) pair per path with `collect_stats`.
+    """
+    import multiprocessing
+    
+    pool = multiprocessing.Pool(jobs, _init_worker,
+        (paths, variables, coords, use_pyparsing, cache_dir, cache_size,
+         template_cache, collect_stats))
+    try:
+        return pool.map(_compile_in_worker, paths, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def render_rules(rules, options):
+    return u''.join(iter_rules(rules, options)).encode('utf8')
+
+
+class Options(object):
+    """Compile options for library use, with the defaults of the cssc.py
+    command line. Any object with these attributes, such as the parsed
+    command line options, works as well."""
+    DEFAULTS = {
+        'css3': False,
+        'prefixes': None,
+        'optimize': False,
+        'max_selectors': 1000,
+        'strict_selectors': False,
+    }
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(self.DEFAULTS)
+        self.__dict__.update(kwargs)
+
+
+class Compiler(object):
+    """Reentrant stylesheet compiler.
+
+    Each instance has its own Jinja environment and sprite registry and
+    keeps no per-call state, so one instance can serve concurrent
+    compile_string()/compile_files() calls from a thread pool. Sprite
+    coordinates given to a call are merged over the registry for that call
+    only; they reach the rendered template and its includes, while
+    templates imported without context see the registry alone.
+    """
+    def __init__(self, searchpath=(), coords=None, options=None,
+                 template_cache=None, cache=None, use_pyparsing=False):
+        self.searchpath = [os.path.abspath(x) for x in searchpath]
+        self.coords = dict(coords or {})
+        self.options = options or Options()
+        self.cache = cache
+        self.parser = CSSCParser(use_pyparsing=use_pyparsing)
+        self.env = new_environment(self.searchpath, template_cache,
+                                   make_sprite_background(self.coords),
+                                   make_sprite_size(self.coords))
+
+    def load_coords(self, coords_defs):
+        """Add `JSON_FILE,URL` sprite coordinates to the registry."""
+        self.coords.update(read_coords(coords_defs))
+
+    def _context(self, variables, coords):
+        context = dict(variables or {})
+        if coords:
+            coords = dict(self.coords, **coords)
+            context['sprite_background'] = make_sprite_background(coords)
+            context['sprite_size'] = make_sprite_size(coords)
+        return context
+
+    def _render(self, rules, options):
+        options = options or self.options
+        if getattr(options, 'optimize', False):
+            rules = optimize_rules(rules, options)
+        return render_rules(rules, options)
+
+    def parse_string(self, text, variables=None, coords=None):
+        """Render `text` as a template and return its parsed rules."""
+        cssbody = self.env.from_string(text).render(self._context(variables, coords))
+        parsed = self.cache.get(cssbody) if self.cache else None
+        if parsed is None:
+            parsed = self.parser.parseString(cssbody)
+            if self.cache:
+                self.cache.set(cssbody, parsed)
+        return parsed
+
+    def compile_string(self, text, variables=None, coords=None, options=None):
+        """Compile the CSSC template `text` and return utf-8 css."""
+        return self._render(self.parse_string(text, variables, coords), options)
+
+    def compile_files(self, paths, variables=None, coords=None, options=None):
+        """Compile the files `paths` into one utf-8 stylesheet.
+
+        The directory of each path must be on the search path, which is
+        where its includes and imports are looked up as well.
+        """
+        context = self._context(variables, coords)
+        rules = []
+        for path in paths:
+            if os.path.dirname(os.path.abspath(path)) not in self.searchpath:
+                raise ValueError('%s is not on the search path' % path)
+            rules.extend(compile_path(self.env, self.parser, path, context, self.cache))
+        return self._render(rules, options)
+
+
+def write_atomic(path, data):
+    """Write `data` to `path` through a temporary file and a rename, so
+    readers never see a partly written file."""
+    import tempfile
+    
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+
+
+class GzipSidecar(object):
+    """Output wrapper that writes through to `output` and compresses the
+    same bytes into `path` (normally OUTPUT.gz, for gzip_static).
+
+    The gzip stream is compressed at `level` with no name or mtime in its
+    header, so the same css always gives the same file. close() leaves an
+    existing sidecar untouched when its content hash matches, and returns
+    True if the sidecar was rewritten. abort() removes the temporary file
+    instead, leaving any existing sidecar as it was.
+    """
+    def __init__(self, output, path, level=9):
+        import tempfile
+        import zlib
+        
+        self.output = output
+        self.path = path
+        self.size = 0
+        self.digest = hashlib.sha1()
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        fd, self.tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+        self.fp = os.fdopen(fd, 'wb')
+    
+    def write(self, data):
+        self.output.write(data)
+        self._write_gz(self.compressor.compress(data))
+    
+    def _write_gz(self, data):
+        if data:
+            self.fp.write(data)
+            self.digest.update(data)
+            self.size += len(data)
+    
+    def close(self):
+        if self.output is not sys.stdout:
+            self.output.close()
+        self._write_gz(self.compressor.flush())
+        self.fp.close()
+        
+        if (os.path.exists(self.path) and os.path.getsize(self.path) == self.size and
+            hashlib.sha1(open(self.path, 'rb').read()).digest() == self.digest.digest()):
+            os.remove(self.tmp)
+            return False
+        os.chmod(self.tmp, 0644)
+        os.rename(self.tmp, self.path)
+        return True
+    
+    def abort(self):
+        if self.output is not sys.stdout:
+            self.output.close()
+        self.fp.close()
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+
+
+def gzip_bytes(data, level=9):
+    """Compress `data` the same way GzipSidecar does."""
+    import zlib
+    
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def open_output(path, gzip=False):
+    """Open `path` for the compiled css, with a .gz sidecar if `gzip`."""
+    output = open(path, 'wb')
+    if gzip:
+        output = GzipSidecar(output, path + '.gz')
+    return output
+
+
+def close_output(output):
+    if isinstance(output, GzipSidecar):
+        state = 'written' if output.close() else 'unchanged'
+        print >>sys.stderr, 'gzip: %s (%s, %d bytes)' % (output.path, state, output.size)
+    elif output is not sys.stdout:
+        output.close()
+
+
+def abort_output(output):
+    """Close `output` after a failed render without replacing a sidecar."""
+    if isinstance(output, GzipSidecar):
+        output.abort()
+    elif output is not sys.stdout:
+        output.close()
+
+
+def normalize_media_query(query):
+    """`screen and (max-width:600px)` and `Screen  and ( max-width: 600px )`
+    are the same query; return one spelling for both."""
+    query = re.sub(r'\s+', ' ', query.strip().lower())
+    return re.sub(r'\s*([(),:])\s*', r'\1', query)
+
+
+def unique_name(name, used):
+    """Return `name`, or `name` with a -2, -3, ... suffix if it is in
+    `used`, and add the result to `used`."""
+    base, ext = os.path.splitext(name)
+    n = 1
+    while name in used:
+        n += 1
+        name = '%s-%d%s' % (base, n, ext)
+    used.add(name)
+    return name
+
+
+def split_bundles(paths, parsed_files, mode, main_name='main'):
+    """Group parsed rules into [(logical name, rules)] bundles.
+
+    mode 'input' makes one bundle per input file. mode 'media' puts all
+    rules outside @media into `main_name`.css and the @media blocks of each
+    query into their own bundle, with any @charset repeated at its top.
+    Names that would collide get a numeric suffix.
+    """
+    used = set()
+    if mode == 'input':
+        return [(unique_name(os.path.splitext(os.path.basename(path))[0] + '.css', used),
+                 parsed)
+                for path, parsed in zip(paths, parsed_files)]
+    
+    import collections
+    
+    main = []
+    by_query = collections.OrderedDict()
+    for parsed in parsed_files:
+        for rule in parsed:
+            if isinstance(rule, Media):
+                by_query.setdefault(normalize_media_query(rule.media), []).append(rule)
+            else:
+                main.append(rule)
+    
+    charsets = [rule for rule in main if isinstance(rule, Charset)][:1]
+    bundles = [(unique_name(main_name + '.css', used), main)]
+    for query, rules in by_query.iteritems():
+        slug = re.sub(r'[^a-z0-9]+', '-', query).strip('-')
+        bundles.append((unique_name('media-%s.css' % slug, used), charsets + rules))
+    return bundles
+
+
+def write_bundles(bundles, directory, options):
+    """Render each bundle into `directory` as NAME.HASH.css and return the
+    {logical name: file name} manifest. A file whose hash already exists
+    has the same content and is left alone."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    
+    manifest = {}
+    for name, rules in bundles:
+        if getattr(options, 'optimize', False):
+            rules = optimize_rules(rules, options)
+        data = render_rules(rules, options)
+        
+        base, ext = os.path.splitext(name)
+        filename = '%s.%s%s' % (base, hashlib.sha1(data).hexdigest()[:12], ext)
+        path = os.path.join(directory, filename)
+        if os.path.exists(path):
+            state = 'unchanged'
+        else:
+            write_atomic(path, data)
+            state = 'written'
+        if getattr(options, 'gzip', False) and (
+                state == 'written' or not os.path.exists(path + '.gz')):
+            write_atomic(path + '.gz', gzip_bytes(data))
+        print >>sys.stderr, 'bundle: %s -> %s (%s, %d bytes)' % (name, filename, state, len(data))
+        manifest[name] = filename
+    return manifest
+
+
+class Watcher(object):
+    """Keeps one Jinja environment and parser warm and recompiles only the
+    inputs whose template, or a template it extends, includes or imports,
+    has changed since the last poll.
+    """
+    def __init__(self, env, parser, paths, variables, options, cache=None):
+        self.env = env
+        self.parser = parser
+        self.paths = paths
+        self.variables = variables
+        self.options = options
+        self.cache = cache
+        
+        self.outputs = {}       # path -> compiled css
+        self.depends = {}       # path -> {filename: mtime}
+        for path in paths:
+            self.compile(path)
+    
+    def template_files(self, name, files=None, seen=None):
+        """Return the file names of template `name` and of every template
+        it references. Dynamically named templates cannot be tracked.
+
+        Each file is added to `files` before it is parsed, so on a syntax
+        error `files` still holds every file found so far.
+        """
+        from jinja2 import meta
+        
+        if files is None:
+            files = []
+        if seen is None:
+            seen = set()
+        seen.add(name)
+        
+        source, filename, uptodate = self.env.loader.get_source(self.env, name)
+        files.append(filename)
+        for ref in meta.find_referenced_templates(self.env.parse(source)):
+            if ref is not None and ref not in seen:
+                self.template_files(ref, files, seen)
+        return files
+    
+    @staticmethod
+    def mtimes(files):
+        result = {}
+        for filename in files:
+            try:
+                result[filename] = os.path.getmtime(filename)
+            except OSError:
+                result[filename] = None
+        return result
+    
+    def compile(self, path):
+        from jinja2 import TemplateError
+        
+        name = os.path.basename(path)
+        files = []
+        try:
+            try:
+                self.template_files(name, files)
+            finally:
+                # record what could be found even if a template is broken,
+                # so fixing it triggers a recompile and an unchanged error
+                # is not reported again on every poll
+                self.depends[path] = self.mtimes(files or [path])
+            rules = compile_path(self.env, self.parser, path, self.variables, self.cache)
+            if getattr(self.options, 'optimize', False):
+                rules = optimize_rules(rules, self.options)
+            output = render_rules(rules, self.options)
+        except (TemplateError, ParseError, EnvironmentError,
+                SelectorLimitError, ValueError), exc:
+            # keep serving the previous output until the error is fixed
+            print >>sys.stderr, '%s: %s' % (path, exc)
+            return False
+        
+        self.outputs[path] = output
+        print >>sys.stderr, 'compiled %s' % path
+        return True
+    
+    def is_stale(self, path):
+        for filename, mtime in self.depends.get(path, {}).iteritems():
+            try:
+                current = os.path.getmtime(filename)
+            except OSError:
+                current = None
+            if current != mtime:
+                return True
+        return False
+    
+    def poll(self):
+        """Recompile stale inputs and return the paths that were rebuilt."""
+        changed = [path for path in self.paths if self.is_stale(path)]
+        rebuilt = [path for path in changed if self.compile(path)]
+        if rebuilt and self.cache:
+            self.cache.evict()
+        return rebuilt
+    
+    def css(self, path=None):
+        if path is not None:
+            return self.outputs.get(path)
+        return ''.join(self.outputs.get(p, '') for p in self.paths)
+
+
+def serve(watcher, port):
+    """Serve the compiled stylesheets from memory in a background thread.
+
+    `/` returns all inputs concatenated, `/NAME.css` the input NAME alone.
+    Responses carry an ETag and conditional requests are answered with 304.
+    """
+    import BaseHTTPServer
+    import SocketServer
+    import threading
+    
+    by_name = dict((os.path.splitext(os.path.basename(path))[0] + '.css', path)
+                   for path in watcher.paths)
+    
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            name = self.path.split('?', 1)[0].lstrip('/')
+            if not name:
+                body = watcher.css()
+            elif name in by_name:
+                body = watcher.css(by_name[name])
+            else:
+                body = None
+            
+            if body is None:
+                self.send_error(404)
+                return
+            
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/css; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+    
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+    
+    server = Server(('127.0.0.1', port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print >>sys.stderr, 'serving on http://127.0.0.1:%d/' % port
+    return server
+
+
+def watch(watcher, options):
+    import time
+    
+    if options.serve:
+        serve(watcher, options.serve)
+    
+    def write_output():
+        if options.output:
+            output = open_output(options.output, options.gzip)
+            try:
+                output.write(watcher.css())
+            except:
+                abort_output(output)
+                raise
+            close_output(output)
+    
+    write_output()
+    try:
+        while True:
+            time.sleep(options.interval)
+            if watcher.poll():
+                write_output()
+    except KeyboardInterrupt:
+        pass
+
+
+
 def parse_args():
     from optparse import OptionParser
     
@@ -393,8 +2028,84 @@ def parse_args():
     parser.add_option("--css3", dest="css3", default=False,
         action="store_true",
         help="Convert CSS3 vendor custom properties")
+    parser.add_option("--prefixes", dest="prefixes",
+                      help="vendor prefix table (JSON, default prefixes.json "
+                           "next to cssc.py)", metavar="FILE")
+    parser.add_option("--pyparsing", dest="pyparsing", default=False,
+        action="store_true",
+        help="parse with the legacy pyparsing grammar")
+    parser.add_option("--cache-dir", dest="cache_dir",
+                      help="cache parsed stylesheets in DIR", metavar="DIR")
+    parser.add_option("--cache-size", dest="cache_size", type="int",
+                      default=64,
+                      help="maximum size of the parse cache in MB (default 64)",
+                      metavar="MB")
+    parser.add_option("--template-cache", dest="template_cache",
+                      help="keep compiled templates in DIR "
+                           "(default CACHE_DIR/templates with --cache-dir)",
+                      metavar="DIR")
+    parser.add_option("--max-selectors", dest="max_selectors", type="int",
+                      default=Options.DEFAULTS['max_selectors'],
+                      help="warn when one rule expands to more than N "
+                           "selectors (default 1000, 0 disables)",
+                      metavar="N")
+    parser.add_option("--strict-selectors", dest="strict_selectors",
+        default=False, action="store_true",
+        help="fail instead of warning when --max-selectors is exceeded")
+    parser.add_option("--optimize", dest="optimize", default=False,
+        action="store_true",
+        help="merge identical rules, drop empty rules and merge @media blocks")
+    parser.add_option("--stats", dest="stats", default=False,
+        action="store_true",
+        help="print phase timings and rule counts per input to stderr")
+    parser.add_option("--stats-json", dest="stats_json",
+                      help="write the --stats numbers to FILE as JSON",
+                      metavar="FILE")
+    parser.add_option("--profile", dest="profile",
+                      help="write cProfile data of the parse phase to FILE",
+                      metavar="FILE")
+    parser.add_option("--bundle", dest="bundle", type="choice",
+                      choices=['input', 'media'],
+                      help="write content hashed bundles, one per input or "
+                           "one per @media query plus the rest",
+                      metavar="input|media")
+    parser.add_option("--bundle-dir", dest="bundle_dir", default='.',
+                      help="directory for --bundle files (default .)",
+                      metavar="DIR")
+    parser.add_option("--manifest", dest="manifest",
+                      help="bundle manifest file "
+                           "(default BUNDLE_DIR/manifest.json)",
+                      metavar="FILE")
+    parser.add_option("--gzip", dest="gzip", default=False,
+                      action="store_true",
+                      help="also write a maximally compressed OUTPUT.gz "
+                           "(and BUNDLE.gz for --bundle)")
+    parser.add_option("--prune-against", dest="prune_against", action="append",
+                      help="drop rules whose selectors use classes, ids or "
+                           "tags not found in the HTML/template files "
+                           "under DIR (may be repeated)",
+                      metavar="DIR")
+    parser.add_option("--prune-whitelist", dest="prune_whitelist",
+                      action="append",
+                      help="class, id or tag names (glob patterns) to keep "
+                           "when pruning, e.g. 'js-*' (may be repeated)",
+                      metavar="PATTERN")
+    parser.add_option("-j", dest="jobs", type="int", default=1,
+                      help="compile inputs in N processes", metavar="N")
+    parser.add_option("--watch", dest="watch", default=False,
+        action="store_true",
+        help="keep running and recompile inputs when their templates change")
+    parser.add_option("--serve", dest="serve", type="int",
+                      help="serve compiled css over HTTP (implies --watch)",
+                      metavar="PORT")
+    parser.add_option("--interval", dest="interval", type="float",
+                      default=0.5,
+                      help="seconds between change checks (default 0.5)",
+                      metavar="SECONDS")
 
     options, args = parser.parse_args()
+    if options.gzip and not (options.output or options.bundle):
+        parser.error('--gzip needs -o or --bundle')
     return options, args
 
 
@@ -406,56 +2117,135 @@ def main():
         return    
     
     variables = {}
-    
     if options.variables:
-        with open(options.variables, 'rb') as fp:
-            for k, v in json.load(fp).iteritems():
-                if isinstance(k, unicode):
-                    k = k.encode('utf8')
-                variables[k] = v
+        variables = load_variables(options.variables)
     
     # load sprite coordinates
     if options.coords:
-        for coords_def in options.coords:
-            coords_name, url = coords_def.split(',', 1)
-            key = os.path.splitext(os.path.basename(coords_name))[0]
-            sprite_coords[key] = {
-                'url': url,
-                'coordinates': json.load(open(coords_name, 'r'))
-            }
-    
-    middle = None
-    
-    # jinja2 setup
-    loader = jinja2.FileSystemLoader([os.path.dirname(path) for path in args])
-    env = jinja2.Environment(loader=loader,
-        extensions=['jinja2.ext.ExprStmtExtension'])
-    env.globals.update({
-        'sprite_background': jinja_sprite_background
-    })
-
-    parser = CSSCParser()
-    rules = []
-    for path in args:
-        t = env.get_template(os.path.basename(path))
-        cssbody = t.render(variables)
-        if middle:
-            middle.write(cssbody.encode('utf-8'))
-            middle.write('\n')
-        
-        try:
-            rules.extend(parser.parseString(cssbody))
-        except ParseException, exc:
-            print >>sys.stderr, 'exception at : `%s`' % exc.markInputline('')
-            raise
-            
-    if options.output:
-        output = open(options.output, 'wb')
+        load_coords(options.coords)
+    
+    template_cache = options.template_cache
+    if not template_cache and options.cache_dir:
+        template_cache = os.path.join(options.cache_dir, 'templates')
+    env = create_environment(args, template_cache)
+    parser = CSSCParser(use_pyparsing=options.pyparsing)
+    cache = None
+    if options.cache_dir:
+        cache = ParseCache(options.cache_dir, options.cache_size * 1024 * 1024)
+    
+    if options.watch or options.serve:
+        watch(Watcher(env, parser, args, variables, options, cache), options)
+        return
+    
+    stats = None
+    if options.stats or options.stats_json or options.profile:
+        stats = BuildStats(profile=bool(options.profile))
+    
+    jobs = options.jobs
+    if options.profile:
+        # the profiler only sees the parse phase of this process
+        jobs = 1
+    
+    parsed_files = []
+    if jobs > 1 and len(args) > 1:
+        results = compile_paths_parallel(args, variables, sprite_coords,
+            min(jobs, len(args)), options.pyparsing,
+            options.cache_dir, options.cache_size * 1024 * 1024,
+            template_cache, stats is not None)
+        if stats:
+            parsed_files = [parsed for parsed, file_stats in results]
+            stats.files = [file_stats for parsed, file_stats in results]
+        else:
+            parsed_files = results
+    else:
+        for path in args:
+            file_stats = stats.add_file(path) if stats else None
+            parsed_files.append(
+                compile_path(env, parser, path, variables, cache, file_stats))
+    
+    if cache:
+        cache.evict()
+    
+    if options.prune_against:
+        index = SelectorIndex(options.prune_whitelist or ())
+        for directory in options.prune_against:
+            index.add_directory(directory)
+        before = after = removed_rules = removed_selectors = 0
+        bodies = {}
+        for i, parsed in enumerate(parsed_files):
+            # count from the flattened rules, so selectors are expanded
+            # (and their warnings printed) once
+            parsed = flatten_rules(parsed, options)
+            before += rendered_size(parsed, options, bodies)
+            parsed, rules_, selectors_ = prune_rules(parsed, index, options)
+            after += rendered_size(parsed, options, bodies)
+            removed_rules += rules_
+            removed_selectors += selectors_
+            parsed_files[i] = parsed
+        print >>sys.stderr, ('prune: %d files indexed, removed %d rules and %d selectors, '
+                             '%d -> %d bytes (saved %d)') % (
+            index.files, removed_rules, removed_selectors, before, after, before - after)
+    
+    if options.bundle:
+        main_name = 'main'
+        if options.output:
+            main_name = os.path.splitext(os.path.basename(options.output))[0]
+        bundles = split_bundles(args, parsed_files, options.bundle, main_name)
+        with (stats.total.phase if stats else _no_phase)('render'):
+            manifest = write_bundles(bundles, options.bundle_dir, options)
+        write_atomic(options.manifest or os.path.join(options.bundle_dir, 'manifest.json'),
+                     json.dumps(manifest, indent=2, sort_keys=True) + '\n')
+        output = None
+    elif options.output:
+        output = open_output(options.output, options.gzip)
     else:
         output = sys.stdout
     
-    for rule in rules:
-        rule.render(options, output)
+    try:
+        if output is None:
+            pass
+        elif options.optimize:
+            rules = []
+            for parsed in parsed_files:
+                rules.extend(parsed)
+            # flatten once: expanding selectors again would repeat warnings
+            rules = flatten_rules(rules, options)
+            bodies = {}
+            before = rendered_size(rules, options, bodies)
+            with (stats.total.phase if stats else _no_phase)('optimize'):
+                rules = optimize_rules(rules, options, bodies)
+            with (stats.total.phase if stats else _no_phase)('render'):
+                data = render_rules(rules, options)
+            print >>sys.stderr, 'optimize: %d -> %d bytes (saved %d)' % (
+                before, len(data), before - len(data))
+            output.write(data)
+            if stats:
+                stats.total.counts['bytes'] = len(data)
+        elif stats:
+            # render each input on its own to time it
+            for parsed, file_stats in zip(parsed_files, stats.files):
+                with file_stats.phase('render'):
+                    data = render_rules(parsed, options)
+                file_stats.counts['bytes'] = len(data)
+                output.write(data)
+        else:
+            write_chunks((chunk for parsed in parsed_files
+                          for chunk in iter_rules(parsed, options)), output)
+    except:
+        if output is not None:
+            abort_output(output)
+        raise
+    if output is not None:
+        close_output(output)
+    
+    if stats:
+        if options.stats:
+            print >>sys.stderr, stats.format_text()
+        if options.stats_json:
+            with open(options.stats_json, 'w') as fp:
+                stats.dump_json(fp)
+        if options.profile:
+            stats.profiler.dump_stats(options.profile)
         
 if __name__ == '__main__':
     main()
@@ -36,12 +36,45 @@ class SpriteBase(object):
         pass
 
     
+def alpha_bbox(image):
+    """
+    不透明な部分を囲む矩形。アルファがなければNone。
+    """
+    if image.mode not in ('RGBA', 'LA') and not (image.mode == 'P' and 'transparency' in image.info):
+        return None
+    return image.convert('RGBA').split()[-1].getbbox()
+
 class Sprite(SpriteBase):
-    def __init__(self, parent, filename, image):
+    def __init__(self, parent, filename, image, trim=False):
         super(Sprite, self).__init__(parent)
 
         self.filename = filename
         self.image = image
+        self.aliases = []   # 同じ画素の別ファイル名
+        self.bbox = None    # trimしたときの元画像での範囲
+        self.original_size = image.size
+        
+        if trim:
+            bbox = alpha_bbox(image)
+            if bbox and bbox != (0, 0) + image.size:
+                self.bbox = bbox
+                self.image = image.crop(bbox)
+    
+    def trim_info(self):
+        # trimしたときは元の大きさと、切り取った位置と大きさを座標jsonに書く
+        if self.bbox is None:
+            return None
+        return {'size': list(self.original_size), 'offset': list(self.bbox[:2]),
+                'trimmed': list(self.image.size)}
+    
+    def pixel_hash(self):
+        import hashlib
+        
+        image = self.image
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        return hashlib.sha1('%dx%d:%r:' % (image.size + (self.trim_info(),)) +
+                            image.tobytes()).digest()
     
     def get_size(self):
         return self.image.size
@@ -49,30 +82,51 @@ class Sprite(SpriteBase):
     
     def build_image(self):
         return self.image
+    
+    def paint(self, canvas, tl):
+        # canvasの絶対座標tlに直接描く
+        canvas.paste(self.image, tl)
+    
+    def paint_size(self):
+        # アトラスに描かれる大きさ
+        return self.size
 
 class FillSprite(Sprite):
     def __init__(self, parent, filename, image, filltype):
         super(FillSprite, self).__init__(parent, filename, image)
         self.filltype = filltype
 
-    def build_image(self):
-        if not self.parent:
-            return self.image
+    def paint_size(self):
+        if not self.parent or isinstance(self.parent, PackedSpriteSet):
+            # packedなセットには伸ばす方向がない
+            return self.size
         
         assert isinstance(self.parent, SpriteSet)
         
         if self.parent.direction == HORIZONTAL:
             # stretch verticaly
-            size = self.size[0], self.parent.size[1]
+            return self.size[0], self.parent.size[1]
         else:
-            size = self.parent.size[0], self.size[1]
+            return self.parent.size[0], self.size[1]
+    
+    def build_image(self):
+        if not self.parent or isinstance(self.parent, PackedSpriteSet):
+            return self.image
         
+        size = self.paint_size()
         if self.filltype == 'stretch':
             image = self.image.resize(size, Image.BICUBIC)
         else:
             image = Image.new('RGBA', self.size, 0x000000FF)
             raise NotImplementedError
         return image, size
+    
+    def paint(self, canvas, tl):
+        t = self.build_image()
+        if isinstance(t, tuple):
+            # 伸ばした画像は描く場所の大きさだけ作ってそのまま貼る
+            t = t[0]
+        canvas.paste(t, tl)
         
 
 class SpriteSet(SpriteBase):
@@ -83,6 +137,14 @@ class SpriteSet(SpriteBase):
         self.direction = direction
         self.sprites = []
         self.size = None
+        self.trim = parent.trim if parent else False
+        self.group = None   # ページ分けのグループ
+    
+    def empty_copy(self):
+        # 並べ方の設定だけ同じ、空のセット
+        ss = SpriteSet(None, self.direction)
+        ss.trim = self.trim
+        return ss
     
     def add_image(self, image):
         #assert isinstance(image, SpriteBase)
@@ -116,19 +178,15 @@ class SpriteSet(SpriteBase):
             self.size = max_size, corner
 
     def build_image(self):
+        # 入れ子のセットごとに画像を作らず、一枚のcanvasに全部描く
         image = Image.new('RGBA', self.size, 0x000000FF)
-        
-        for sprite in self.sprites:
-            tl = sprite.topleft
-            t = sprite.build_image()
-            if isinstance(t, (tuple, list)):
-                im, sz = t
-            else:
-                im = t
-                sz = sprite.size
-            bounds = (tl[0], tl[1], tl[0] + sz[0], tl[1] + sz[1])
-            image.paste(im, bounds)
+        self.paint(image, (0, 0))
         return image
+    
+    def paint(self, canvas, base_topleft):
+        for sprite in self.sprites:
+            tl = base_topleft[0] + sprite.topleft[0], base_topleft[1] + sprite.topleft[1]
+            sprite.paint(canvas, tl)
 
     def dump_coords(self, base_topleft=(0, 0)):
         result = []
@@ -137,30 +195,287 @@ class SpriteSet(SpriteBase):
             if isinstance(sprite, SpriteSet):
                 result.extend(sprite.dump_coords(tl))
             else:
-                result.append((sprite.filename, (tl[0], tl[1])))
+                coord = tl[0], tl[1]
+                info = sprite.trim_info()
+                if info:
+                    coord += (info,)
+                result.append((sprite.filename, coord))
+                for alias in sprite.aliases:
+                    result.append((alias, coord))
         return result
+    
+    def dedup(self, seen=None):
+        """
+        画素が同じ画像は最初の一つだけ残し、残りはその別名にする。
+        取り除いたSpriteのリストを返す。make_positionをやり直すこと。
+        """
+        if seen is None:
+            seen = {}
+        removed = []
+        sprites = []
+        for sprite in self.sprites:
+            if isinstance(sprite, SpriteSet):
+                removed.extend(sprite.dedup(seen))
+                if not sprite.sprites:
+                    continue
+            elif not isinstance(sprite, FillSprite):
+                # FillSpriteは親によって大きさが変わるので対象外
+                key = sprite.pixel_hash()
+                original = seen.get(key)
+                if original is not None:
+                    for name in [sprite.filename] + sprite.aliases:
+                        if name != original.filename and name not in original.aliases:
+                            original.aliases.append(name)
+                    removed.append(sprite)
+                    continue
+                seen[key] = sprite
+            sprites.append(sprite)
+        self.sprites = sprites
+        return removed
+
+    def iter_sprites(self, base_topleft=(0, 0)):
+        """
+        画像ごとに (Sprite, 絶対座標) を返す。
+        """
+        for sprite in self.sprites:
+            tl = base_topleft[0] + sprite.topleft[0], base_topleft[1] + sprite.topleft[1]
+            if isinstance(sprite, SpriteSet):
+                for x in sprite.iter_sprites(tl):
+                    yield x
+            else:
+                yield sprite, tl
+    
+    def iter_sets(self):
+        yield self
+        for sprite in self.sprites:
+            if isinstance(sprite, SpriteSet):
+                for x in sprite.iter_sets():
+                    yield x
+
+class MaxRectsPacker(object):
+    """
+    MaxRects (best short side fit) で矩形を幅 width の領域に詰める。
+    高さは無制限で、置いた位置のリストを返す。
+    """
+    def __init__(self, width):
+        self.width = width
+        self.free = [(0, 0, width, sys.maxint)]
+    
+    def insert(self, w, h):
+        best = None
+        for fx, fy, fw, fh in self.free:
+            if w <= fw and h <= fh:
+                score = (min(fw - w, fh - h), max(fw - w, fh - h), fy)
+                if best is None or score < best[0]:
+                    best = score, (fx, fy)
+        if best is None:
+            return None
+        x, y = best[1]
+        self.split(x, y, w, h)
+        return x, y
+    
+    def split(self, x, y, w, h):
+        free = []
+        for fx, fy, fw, fh in self.free:
+            if x >= fx + fw or x + w <= fx or y >= fy + fh or y + h <= fy:
+                free.append((fx, fy, fw, fh))
+                continue
+            # 重なった空き領域を、置いた矩形の上下左右に分ける
+            if x > fx:
+                free.append((fx, fy, x - fx, fh))
+            if x + w < fx + fw:
+                free.append((x + w, fy, fx + fw - x - w, fh))
+            if y > fy:
+                free.append((fx, fy, fw, y - fy))
+            if y + h < fy + fh:
+                free.append((fx, y + h, fw, fy + fh - y - h))
+        
+        # 他の空き領域に含まれるものは捨てる
+        free.sort(key=lambda r: -r[2] * r[3])
+        self.free = []
+        for r in free:
+            for o in self.free:
+                if r[0] >= o[0] and r[1] >= o[1] and \
+                        r[0] + r[2] <= o[0] + o[2] and r[1] + r[3] <= o[1] + o[3]:
+                    break
+            else:
+                self.free.append(r)
+
+def next_power_of_two(n):
+    p = 1
+    while p < n:
+        p *= 2
+    return p
+
+class PackedSpriteSet(SpriteSet):
+    """
+    `layout: packed` のスプライトセット。
+    子を縦横の帯に並べるのではなく、MaxRectsで隙間なく詰める。
+    max_size (幅, 高さ) を指定すると、それに収まる並べ方を優先する。
+    """
+    def __init__(self, parent, direction, padding=0, power_of_two=False, max_size=None):
+        super(PackedSpriteSet, self).__init__(parent, direction)
+        self.padding = padding
+        self.power_of_two = power_of_two
+        self.max_size = max_size
+        self.strip_size = None
+    
+    def empty_copy(self):
+        ss = PackedSpriteSet(None, self.direction, self.padding, self.power_of_two,
+                             self.max_size)
+        ss.trim = self.trim
+        return ss
+    
+    def make_position(self):
+        for sprite in self.sprites:
+            sprite.make_position()
+        
+        if not self.sprites:
+            # 空のセットはSpriteSetと同じく大きさ0
+            self.size = self.strip_size = 0, 0
+            return
+        
+        # 比較用に、帯に並べたときの大きさ
+        sizes = [sprite.size for sprite in self.sprites]
+        if self.direction == HORIZONTAL:
+            self.strip_size = sum(w for w, h in sizes), max(h for w, h in sizes)
+        else:
+            self.strip_size = max(w for w, h in sizes), sum(h for w, h in sizes)
+        
+        # 大きいものから置く
+        pad = self.padding
+        order = sorted(range(len(self.sprites)),
+                       key=lambda i: (-max(sizes[i]), -min(sizes[i]), i))
+        area = sum((w + pad) * (h + pad) for w, h in sizes)
+        min_width = max(w for w, h in sizes) + pad
+        
+        # 幅をいくつか試して、面積が一番小さいものを使う
+        candidates = set([min_width, self.strip_size[0] + pad])
+        side = int(area ** 0.5)
+        for f in (0.75, 1.0, 1.25, 1.5, 2.0):
+            candidates.add(max(min_width, int(side * f)))
+        max_width, max_height = self.max_size or (None, None)
+        if max_width:
+            candidates.add(max(min_width, max_width + pad))
+            candidates = set(w for w in candidates if w <= max(min_width, max_width + pad))
+        if self.power_of_two:
+            candidates = set(max(min_width, next_power_of_two(w)) for w in candidates)
+        
+        best = None
+        for width in sorted(candidates):
+            packer = MaxRectsPacker(width)
+            positions = {}
+            for i in order:
+                w, h = sizes[i]
+                positions[i] = packer.insert(w + pad, h + pad)
+            size = (max(positions[i][0] + sizes[i][0] for i in order),
+                    max(positions[i][1] + sizes[i][1] for i in order))
+            if self.power_of_two:
+                size = next_power_of_two(size[0]), next_power_of_two(size[1])
+            over = bool(max_width and size[0] > max_width or
+                        max_height and size[1] > max_height)
+            key = over, size[0] * size[1], max(size)
+            if best is None or key < best[0]:
+                best = key, size, positions
+        
+        self.size = best[1]
+        for i, sprite in enumerate(self.sprites):
+            sprite.set_topleft(best[2][i])
+    
+    def fill_ratio(self, size):
+        used = sum(sprite.size[0] * sprite.size[1] for sprite in self.sprites)
+        if not used:
+            return 0.0
+        return float(used) / (size[0] * size[1])
+    
+    def report(self):
+        return 'packed %dx%d (fill %.1f%%), strip %dx%d (fill %.1f%%)' % (
+            self.size[0], self.size[1], self.fill_ratio(self.size) * 100,
+            self.strip_size[0], self.strip_size[1], self.fill_ratio(self.strip_size) * 100)
+
 
 class ImageLoader(object):
-    def __init__(self, base_dir='.'):
+    def __init__(self, base_dir='.', jobs=None, trim=False):
         self.base_dir = base_dir
+        self.jobs = jobs
+        self.trim = trim
+        self.images = {}
     
     def load(self, yamlfile):
-        sprite = self.load_sprite(None, yaml.load(open(yamlfile)))
+        dataset = yaml.load(open(yamlfile))
+        self.open_images(self.collect_filenames(dataset))
+        sprite = self.load_sprite(None, dataset)
         sprite.make_position()
         
         return sprite
     
+    def collect_filenames(self, dataset, result=None):
+        """
+        定義に出てくる画像ファイル名を、重複なしで出てきた順に返す。
+        """
+        if result is None:
+            result = []
+        if isinstance(dataset, str):
+            if dataset not in result:
+                result.append(dataset)
+        elif isinstance(dataset, dict):
+            if 'images' in dataset:
+                self.collect_filenames(dataset['images'], result)
+            elif 'image' in dataset:
+                self.collect_filenames(dataset['image'], result)
+        elif isinstance(dataset, list):
+            for x in dataset:
+                self.collect_filenames(x, result)
+        return result
+    
+    def open_images(self, filenames):
+        """
+        filenames をスレッドプールで読み込んでデコードしておく。
+        PILはデコード中にGILを手放すので、スレッドでも並列に動く。
+        """
+        filenames = [x for x in filenames if x not in self.images]
+        
+        def decode(filename):
+            image = Image.open(os.path.join(self.base_dir, filename))
+            image.load()
+            return image
+        
+        jobs = self.jobs
+        if jobs is None:
+            import multiprocessing
+            jobs = multiprocessing.cpu_count()
+        
+        if len(filenames) > 1 and jobs > 1:
+            from multiprocessing.pool import ThreadPool
+            
+            pool = ThreadPool(min(jobs, len(filenames)))
+            try:
+                images = pool.map(decode, filenames)
+            finally:
+                pool.close()
+        else:
+            images = map(decode, filenames)
+        self.images.update(zip(filenames, images))
+    
+    def open_image(self, filename):
+        # 同じファイルは一度だけ開いて、全部のSpriteで共有する
+        image = self.images.get(filename)
+        if image is None:
+            self.open_images([filename])
+            image = self.images[filename]
+        return image
+    
     def load_sprite(self, parent, dataset):
         assert parent is None or isinstance(parent, SpriteSet)
         
         direction = HORIZONTAL
-        if parent:
+        if parent and not isinstance(parent, PackedSpriteSet):
             direction = 1 - parent.direction
 
         if isinstance(dataset, str):
             # is sprite image file name.
-            image = Image.open(os.path.join(self.base_dir, dataset))
-            return Sprite(parent, dataset, image)
+            image = self.open_image(dataset)
+            return Sprite(parent, dataset, image, parent.trim if parent else self.trim)
         elif isinstance(dataset, dict):
             # is sprite set
             if 'images' in dataset:
@@ -169,33 +484,434 @@ class ImageLoader(object):
                 direction = HORIZONTAL if dataset.get('direction', S_HORIZONTAL) == S_HORIZONTAL else VERTICAL
                 imagelist = dataset['images']
                 
-                return self.load_sprite_set(parent, direction, imagelist)
+                if dataset.get('layout') == 'packed':
+                    ss = PackedSpriteSet(parent, direction,
+                                         padding=dataset.get('padding', 0),
+                                         power_of_two=dataset.get('power_of_two', False))
+                else:
+                    ss = SpriteSet(parent, direction)
+                # 指定がなければ親(一番上はコマンドラインの--trim)に従う
+                ss.trim = bool(dataset.get('trim', ss.trim if parent else self.trim))
+                ss.group = dataset.get('group')
+                return self.load_sprite_set(parent, direction, imagelist, ss)
             elif 'fill' in dataset:
                 assert 'image' in dataset
                 
                 filename = dataset['image']
-                image = Image.open(os.path.join(self.base_dir, filename))
+                image = self.open_image(filename)
                 return FillSprite(parent, filename, image, dataset['fill'])
                 
         elif isinstance(dataset, list):
             # is sprite set by simple alsfjleaflasef. inverted direction of parent
             return self.load_sprite_set(parent, direction, dataset)
 
-    def load_sprite_set(self, parent, direction, imagelist):
-        ss = SpriteSet(parent, direction)
+    def load_sprite_set(self, parent, direction, imagelist, ss=None):
+        if ss is None:
+            ss = SpriteSet(parent, direction)
+            if parent is None:
+                ss.trim = self.trim
         for dataset in imagelist:
             ss.add_image(self.load_sprite(ss, dataset))
         return ss
 
 ###
-def build_sprite(yamlfile, output_file='sprite.png', base_dir='.', coordinate_file=None):
-    sprite = ImageLoader(base_dir).load(yamlfile)
+MANIFEST_VERSION = 2
+
+def file_sha1(path):
+    import hashlib
+    
+    with open(path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+def image_entry(path, image_size, sha1=None):
+    st = os.stat(path)
+    return {
+        'mtime': st.st_mtime,
+        'bytes': st.st_size,
+        'sha1': sha1 or file_sha1(path),
+        'size': list(image_size),
+    }
+
+def make_manifest(yaml_sha1, settings, sprite, loader, output_file):
+    """
+    次回の差分ビルド用に、定義と各画像のハッシュ、配置、出力のハッシュをまとめる。
+    """
+    aliased = set()
+    for sprite_, tl in sprite.iter_sprites():
+        if sprite_.aliases:
+            aliased.add(sprite_.filename)
+            aliased.update(sprite_.aliases)
+    
+    images = {}
+    for filename, image in loader.images.iteritems():
+        images[filename] = image_entry(os.path.join(loader.base_dir, filename), image.size)
+    
+    return {
+        'version': MANIFEST_VERSION,
+        'yaml': yaml_sha1,
+        'settings': settings,
+        'images': images,
+        'layout': {
+            'size': list(sprite.size),
+            'rects': [[s.filename, tl[0], tl[1]] + list(s.paint_size()) +
+                      [s.bbox and list(s.bbox)]
+                      for s, tl in sprite.iter_sprites()],
+            'aliased': sorted(aliased),
+        },
+        'coords': dict(sprite.dump_coords()),
+        'output': file_sha1(output_file),
+    }
+
+def load_manifest(manifest_file, yaml_sha1, settings, output_file):
+    """
+    前回のマニフェストが今回の定義・設定・出力ファイルと合っていれば返す。
+    """
+    import json
+    
+    if not os.path.exists(manifest_file) or not os.path.exists(output_file):
+        return None
+    try:
+        manifest = json.load(open(manifest_file))
+    except ValueError:
+        return None
+    if manifest.get('version') != MANIFEST_VERSION or manifest.get('yaml') != yaml_sha1 or \
+            manifest.get('settings') != settings or manifest.get('output') != file_sha1(output_file):
+        return None
+    return manifest
+
+def changed_images(manifest, base_dir):
+    """
+    前回から中身の変わった画像のファイル名を返す。
+    mtimeと大きさが同じならハッシュは取らない。
+    """
+    changed = []
+    for filename, entry in manifest['images'].iteritems():
+        path = os.path.join(base_dir, filename)
+        st = os.stat(path)
+        if st.st_mtime == entry['mtime'] and st.st_size == entry['bytes']:
+            continue
+        sha1 = file_sha1(path)
+        if sha1 != entry['sha1']:
+            changed.append(filename)
+        else:
+            entry['mtime'] = st.st_mtime
+            entry['bytes'] = st.st_size
+    return changed
+
+def repaint(manifest, changed, base_dir, output_file):
+    """
+    大きさの変わらない画像だけが変わったときは、前回の配置のまま
+    前回の画像のその部分だけを描き直す。できなければFalseを返す。
+    """
+    aliased = set(manifest['layout']['aliased'])
+    images = {}
+    for filename in changed:
+        if filename in aliased:
+            # 同じ画素だったものが変わったので、配置をやり直す
+            return False
+        image = Image.open(os.path.join(base_dir, filename))
+        if list(image.size) != manifest['images'][filename]['size']:
+            return False
+        image.load()
+        images[filename] = image
+    
+    pieces = []
+    for filename, x, y, w, h, bbox in manifest['layout']['rects']:
+        image = images.get(filename)
+        if image is None:
+            continue
+        if bbox:
+            # trimした範囲が変わったら配置も変わる
+            if list(alpha_bbox(image) or ()) != bbox:
+                return False
+            image = image.crop(tuple(bbox))
+        elif image.size != (w, h):
+            # FillSprite
+            image = image.resize((w, h), Image.BICUBIC)
+        pieces.append((image, (x, y, x + w, y + h)))
+    
+    atlas = Image.open(output_file)
+    if atlas.mode != 'RGBA':
+        atlas = atlas.convert('RGBA')
+    for image, box in pieces:
+        atlas.paste(image, box)
+    settings = manifest['settings']
+    save_atlas(atlas, output_file, settings['compress_level'], settings['palette'])
+    
+    for filename, image in images.iteritems():
+        manifest['images'][filename] = image_entry(os.path.join(base_dir, filename), image.size)
+    manifest['output'] = file_sha1(output_file)
+    return True
+
+def palette_image(image):
+    """
+    256色以下なら、同じ画素になるパレット(P)画像を返す。多すぎればNone。
+    アルファはtRNSとしてパレットごとに持たせる。
+    """
+    colors = image.getcolors(256)
+    if colors is None:
+        return None
+    
+    colors = [c for n, c in sorted(colors, reverse=True)]
+    index = dict((c, i) for i, c in enumerate(colors))
+    result = Image.new('P', image.size)
+    result.putdata([index[p] for p in image.getdata()])
+    palette = []
+    for r, g, b, a in colors:
+        palette.extend((r, g, b))
+    result.putpalette(palette)
+    if any(a != 255 for r, g, b, a in colors):
+        result.info['transparency'] = ''.join(chr(a) for r, g, b, a in colors)
+    return result
+
+def encode_png(image, **params):
+    import StringIO
+    
+    buf = StringIO.StringIO()
+    if 'transparency' in image.info:
+        params['transparency'] = image.info['transparency']
+    image.save(buf, 'PNG', **params)
+    return buf.getvalue()
+
+def encode_atlas(image, compress_level=9, palette=True):
+    """
+    アトラスを一番小さくなる形式でpngにする。
+    256色以下ならパレット(PNG8)、不透明ならRGB、それ以外はRGBAで、
+    どれも画素は変わらない。(pngのデータ, モード, 何もしないときの大きさ)を返す。
+    """
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    # PILのoptimizeは圧縮レベルを9にしてしまうので、9のときだけ使う
+    params = {'optimize': compress_level == 9, 'compress_level': compress_level}
+    
+    candidates = [image]
+    if palette:
+        p = palette_image(image)
+        if p is not None:
+            candidates.append(p)
+    if image.split()[-1].getextrema()[0] == 255:
+        # アルファを使っていない
+        candidates.append(image.convert('RGB'))
+    
+    # 何もしないでRGBAで書いたほうが小さいこともある
+    naive = encode_png(image)
+    data, mode = min([(encode_png(x, **params), x.mode) for x in candidates] +
+                     [(naive, image.mode)], key=lambda x: len(x[0]))
+    return data, mode, len(naive)
+
+def save_atlas(image, output_file, compress_level=9, palette=True):
+    """
+    encode_atlasで書き出す。(書いた大きさ, 何もしないときの大きさ, モード)を返す。
+    """
+    data, mode, naive_size = encode_atlas(image, compress_level, palette)
+    with open(output_file, 'wb') as fp:
+        fp.write(data)
+    return len(data), naive_size, mode
+
+def make_page(template, units):
+    """
+    template と同じ並べ方のセットに units を入れて配置したものを返す。
+    """
+    page = template.empty_copy()
+    for unit in units:
+        unit.parent = page
+        page.add_image(unit)
+    page.make_position()
+    return page
+
+def split_pages(root, max_width=None, max_height=None, max_bytes=None,
+                compress_level=9, palette=True):
+    """
+    一番上のセットの子を、大きさとバイト数の上限に収まるページに分ける。
+    `group:` を指定したセットは同じグループのものだけでページを作る。
+    ページは大きさの上限まで詰めて並べる。(グループ名, ページ) のリストを返す。
+    """
+    groups = []
+    units = {}
+    for unit in root.sprites:
+        group = getattr(unit, 'group', None)
+        if group not in units:
+            groups.append(group)
+            units[group] = []
+        units[group].append(unit)
+    
+    def fits(page):
+        if max_width and page.size[0] > max_width:
+            return False
+        if max_height and page.size[1] > max_height:
+            return False
+        if max_bytes and len(encode_atlas(page.build_image(), compress_level, palette)[0]) > max_bytes:
+            return False
+        return True
+    
+    def paginate(ss, rest):
+        packed = PackedSpriteSet(None, ss.direction,
+                                 getattr(ss, 'padding', 0),
+                                 getattr(ss, 'power_of_two', False),
+                                 (max_width, max_height))
+        packed.trim = ss.trim
+        
+        def layout(units):
+            # FillSpriteは帯の向きに伸ばすので、そのページはセットの並べ方のまま
+            if any(isinstance(unit, FillSprite) for unit in units):
+                return make_page(ss, units)
+            return make_page(packed, units)
+        
+        pages = []
+        while rest:
+            # 収まる一番多い個数を、倍々に増やしてから二分探索で探す
+            n = 1
+            while n < len(rest) and fits(layout(rest[:min(n * 2, len(rest))])):
+                n = min(n * 2, len(rest))
+            hi = min(n * 2, len(rest) + 1)
+            while hi - n > 1:
+                mid = (n + hi) // 2
+                if fits(layout(rest[:mid])):
+                    n = mid
+                else:
+                    hi = mid
+            page = layout(rest[:n])
+            if n == 1 and not fits(page):
+                unit = rest[0]
+                if isinstance(unit, SpriteSet) and unit.sprites:
+                    # 一つのセットが収まらなければ、その中身だけでページを作る
+                    pages.extend(paginate(unit, unit.sprites))
+                    rest = rest[1:]
+                    continue
+                print >>sys.stderr, 'warning: %s does not fit in one page' % (
+                    ', '.join(name for name, coord in page.dump_coords()[:3]))
+            pages.append(page)
+            rest = rest[n:]
+        return pages
+    
+    pages = []
+    for group in groups:
+        pages.extend((group, page) for page in paginate(root, units[group]))
+    return pages
+
+def page_filename(output_file, group, number):
+    base, ext = os.path.splitext(output_file)
+    if group:
+        return '%s-%s-%d%s' % (base, group, number, ext)
+    return '%s-%d%s' % (base, number, ext)
+
+def build_pages(root, output_file, max_width=None, max_height=None, max_bytes=None,
+                compress_level=9, palette=True):
+    """
+    ページに分けて書き出し、ページのファイル名を入れた座標を返す。
+    """
+    coords = {}
+    numbers = {}
+    for group, page in split_pages(root, max_width, max_height, max_bytes,
+                                   compress_level, palette):
+        numbers[group] = numbers.get(group, 0) + 1
+        filename = page_filename(output_file, group, numbers[group])
+        size, naive_size, mode = save_atlas(page.build_image(), filename, compress_level, palette)
+        print >>sys.stderr, '%s: %dx%d, %d bytes as %s (%d bytes as plain RGBA)' % (
+            filename, page.size[0], page.size[1], size, mode, naive_size)
+        
+        page_name = os.path.basename(filename)
+        for name, coord in page.dump_coords():
+            info = dict(coord[2]) if len(coord) > 2 else {}
+            info['page'] = page_name
+            coords[name] = (coord[0], coord[1], info)
+    return coords
+
+def write_coords(coordinate_file, coords, gzip=False):
+    import json
+    
+    data = json.dumps(coords)
+    with open(coordinate_file, 'w') as fp:
+        fp.write(data)
+    if gzip:
+        write_gzip_sidecar(coordinate_file, data)
+
+def write_manifest(manifest_file, manifest):
+    import json
+    
+    with open(manifest_file, 'w') as fp:
+        json.dump(manifest, fp, indent=1, sort_keys=True)
+
+def write_gzip_sidecar(path, data, level=9):
+    """
+    path + '.gz' に data を最大圧縮で書き出す。
+    中身が同じ(ハッシュが一致する)ときは書き換えない。
+    """
+    import zlib, hashlib
+    
+    # ヘッダに名前も時刻も入れないので、同じ内容なら同じファイルになる
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compressed = compressor.compress(data) + compressor.flush()
+    
+    gzpath = path + '.gz'
+    if os.path.exists(gzpath) and os.path.getsize(gzpath) == len(compressed):
+        if hashlib.sha1(open(gzpath, 'rb').read()).digest() == hashlib.sha1(compressed).digest():
+            return False
+    with open(gzpath, 'wb') as fp:
+        fp.write(compressed)
+    return True
+
+def build_sprite(yamlfile, output_file='sprite.png', base_dir='.', coordinate_file=None,
+                 gzip=False, jobs=None, dedup=False, manifest_file=None, force=False,
+                 trim=False, compress_level=9, palette=True,
+                 max_width=None, max_height=None, max_bytes=None):
+    import hashlib
+    
+    yaml_sha1 = hashlib.sha1(open(yamlfile, 'rb').read()).hexdigest()
+    settings = {'dedup': dedup, 'trim': trim, 'compress_level': compress_level, 'palette': palette,
+                'pages': [max_width, max_height, max_bytes]}
+    
+    manifest = None
+    if manifest_file and not force:
+        manifest = load_manifest(manifest_file, yaml_sha1, settings, output_file)
+    if manifest is not None:
+        changed = changed_images(manifest, base_dir)
+        if not changed:
+            if coordinate_file and not os.path.exists(coordinate_file):
+                write_coords(coordinate_file, manifest['coords'], gzip)
+            write_manifest(manifest_file, manifest)
+            print >>sys.stderr, '%s is up to date' % output_file
+            return
+        if repaint(manifest, changed, base_dir, output_file):
+            if coordinate_file and not os.path.exists(coordinate_file):
+                write_coords(coordinate_file, manifest['coords'], gzip)
+            write_manifest(manifest_file, manifest)
+            print >>sys.stderr, 'repainted %d images: %s' % (len(changed), ', '.join(sorted(changed)))
+            return
+    
+    loader = ImageLoader(base_dir, jobs, trim)
+    sprite = loader.load(yamlfile)
+    if dedup:
+        before = sprite.size
+        removed = sprite.dedup()
+        sprite.make_position()
+        pixels = before[0] * before[1] - sprite.size[0] * sprite.size[1]
+        print >>sys.stderr, 'dedup: %d duplicate images, %dx%d -> %dx%d (saved %d pixels, %d bytes as RGBA)' % (
+            len(removed), before[0], before[1], sprite.size[0], sprite.size[1], pixels, pixels * 4)
+    for ss in sprite.iter_sets():
+        if isinstance(ss, PackedSpriteSet):
+            print >>sys.stderr, ss.report()
+    
+    if max_width or max_height or max_bytes or any(
+            getattr(unit, 'group', None) for unit in sprite.sprites):
+        # 複数のページに分ける
+        coords = build_pages(sprite, output_file, max_width, max_height, max_bytes,
+                             compress_level, palette)
+        if coordinate_file:
+            write_coords(coordinate_file, coords, gzip)
+        if manifest_file:
+            print >>sys.stderr, 'warning: the manifest is not used for paged sprites'
+        return
+    
     sprite_image = sprite.build_image()
-    sprite_image.save(output_file, 'PNG')
+    size, naive_size, mode = save_atlas(sprite_image, output_file, compress_level, palette)
+    print >>sys.stderr, '%s: %d bytes as %s (%d bytes as plain RGBA, saved %d)' % (
+        output_file, size, mode, naive_size, naive_size - size)
     
     if coordinate_file:
-        import json
-        json.dump(dict(sprite.dump_coords()), open(coordinate_file, 'w'))
+        write_coords(coordinate_file, dict(sprite.dump_coords()), gzip)
+    if manifest_file:
+        write_manifest(manifest_file, make_manifest(yaml_sha1, settings, sprite, loader, output_file))
     
 def get_options():
     import optparse
@@ -224,6 +940,80 @@ def get_options():
         default='sprite.json',
         help="output image coordinates as json format. default 'sprite.json'"
     )
+    parser.add_option(
+        '-j', '--jobs',
+        action='store', type='int',
+        dest='jobs',
+        default=None,
+        help="number of threads decoding images. default number of CPUs"
+    )
+    parser.add_option(
+        '-d', '--dedup',
+        action='store_true',
+        dest='dedup',
+        default=False,
+        help="place images with identical pixels only once"
+    )
+    parser.add_option(
+        '-t', '--trim',
+        action='store_true',
+        dest='trim',
+        default=False,
+        help="crop transparent borders of every image (`trim: true` in a set does it per set)"
+    )
+    parser.add_option(
+        '-l', '--compress-level',
+        action='store', type='int',
+        dest='compress_level',
+        default=9,
+        help="zlib compression level of the png (0-9). default 9"
+    )
+    parser.add_option(
+        '--no-palette',
+        action='store_false',
+        dest='palette',
+        default=True,
+        help="do not write a palette (PNG8) image even if it would be lossless"
+    )
+    parser.add_option(
+        '--max-width',
+        action='store', type='int',
+        dest='max_width',
+        help="split the sprite into pages no wider than this"
+    )
+    parser.add_option(
+        '--max-height',
+        action='store', type='int',
+        dest='max_height',
+        help="split the sprite into pages no higher than this"
+    )
+    parser.add_option(
+        '--max-bytes',
+        action='store', type='int',
+        dest='max_bytes',
+        help="split the sprite into pages of at most this many png bytes"
+    )
+    parser.add_option(
+        '-m', '--manifest',
+        action='store', type='string',
+        dest='manifest_file',
+        default=None,
+        help="build manifest (json). skip or repaint the sprite when nothing or only pixels changed"
+    )
+    parser.add_option(
+        '-f', '--force',
+        action='store_true',
+        dest='force',
+        default=False,
+        help="rebuild everything even if the manifest says it is up to date"
+    )
+    parser.add_option(
+        '-z', '--gzip',
+        action='store_true',
+        dest='gzip',
+        default=False,
+        help="also write a maximally compressed coordinate file (`sprite.json.gz`)"
+    )
     
     options, args = parser.parse_args()
     